@@ -0,0 +1,121 @@
+# serving rendered files
+# the api serves everything in a job directory at the same path next.js
+# serves it from public/ (/animations/<job>/<file>), so clients don't need
+# the static folder. finished files answer range requests, which is what
+# video players use to seek. a video that is still being encoded in the
+# fragmented layout is streamed as ffmpeg writes it, so playback can start
+# long before the render is done
+import asyncio
+import mimetypes
+import os
+import re
+from fastapi import HTTPException
+from fastapi.responses import Response, StreamingResponse
+from api.media import MP4_LAYOUT, partial_path
+from api.utils import OUTPUT_DIR, JOB_ID_PATTERN
+
+CHUNK_SIZE = 64 * 1024
+FOLLOW_INTERVAL = 0.1 # seconds between checks for new data in a file being written
+# give up on a file being written that hasn't grown in this many seconds
+FOLLOW_TIMEOUT = float(os.environ.get('SONIFY_STREAM_TIMEOUT', 60))
+
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+# rewritten after every segment while hls / dash output is being written
+PLAYLIST_EXTENSIONS = ('.m3u8', '.mpd')
+
+
+def artifact_path(job_id: str, filename: str) -> str:
+  # only plain file names inside a real job directory, and never the
+  # progress and cancel markers
+  if not JOB_ID_PATTERN.match(job_id) or filename.startswith('.') or os.path.basename(filename) != filename:
+    raise HTTPException(status_code=404, detail='not found')
+  return os.path.join(OUTPUT_DIR, job_id, filename)
+
+def parse_range(header: str, size: int):
+  """
+  (start, end) of a single range Range header, end inclusive, or None to
+  send the whole file. Raises ValueError when it can't be satisfied.
+  """
+  match = RANGE_PATTERN.match(header.strip()) if header else None
+  if match is None:
+    return None # missing, multiple ranges or another unit: the whole file is a valid answer
+  first, last = match.groups()
+  if not first and not last:
+    return None
+  if not first:
+    # the last n bytes
+    start, end = max(0, size - int(last)), size - 1
+  else:
+    start, end = int(first), min(int(last), size - 1) if last else size - 1
+  if start >= size or start > end:
+    raise ValueError(f'range {header} not satisfiable for {size} bytes')
+  return start, end
+
+async def read_range(path: str, start: int, end: int):
+  with open(path, 'rb') as f:
+    f.seek(start)
+    remaining = end - start + 1
+    while remaining > 0:
+      chunk = await asyncio.to_thread(f.read, min(CHUNK_SIZE, remaining))
+      if not chunk:
+        return
+      remaining -= len(chunk)
+      yield chunk
+
+async def follow(f, path: str):
+  # everything ffmpeg writes to the .part, until it is renamed to the real
+  # name (done) or removed (failed or cancelled). the open file keeps
+  # reading either way, so nothing written before that is lost. the file is
+  # closed however the stream ends, the client going away included
+  with f:
+    idle = 0.0
+    while True:
+      chunk = await asyncio.to_thread(f.read, CHUNK_SIZE)
+      if chunk:
+        idle = 0.0
+        yield chunk
+        continue
+      if not os.path.exists(path) or idle >= FOLLOW_TIMEOUT:
+        while chunk := await asyncio.to_thread(f.read, CHUNK_SIZE):
+          yield chunk
+        return
+      await asyncio.sleep(FOLLOW_INTERVAL)
+      idle += FOLLOW_INTERVAL
+
+def serve_artifact(job_id: str, filename: str, range_header: str = None, head: bool = False):
+  # head answers with the same status and headers as the GET, without a body
+  path = artifact_path(job_id, filename)
+  media_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+  if not os.path.exists(path) and MP4_LAYOUT == 'fragmented' and os.path.exists(partial_path(path)):
+    # the length isn't known yet, so this is a plain 200 without ranges
+    headers = {'Cache-Control': 'no-store'}
+    if head:
+      return Response(media_type=media_type, headers=headers)
+    try:
+      f = open(partial_path(path), 'rb')
+    except FileNotFoundError:
+      pass # finished (or failed) since we looked
+    else:
+      return StreamingResponse(follow(f, partial_path(path)), media_type=media_type, headers=headers)
+
+  try:
+    size = os.path.getsize(path)
+  except FileNotFoundError:
+    raise HTTPException(status_code=404, detail='not found')
+  try:
+    byte_range = parse_range(range_header, size)
+  except ValueError:
+    raise HTTPException(status_code=416, detail='range not satisfiable', headers={'Content-Range': f'bytes */{size}'})
+
+  start, end = byte_range or (0, size - 1)
+  headers = {'Accept-Ranges': 'bytes', 'Content-Length': str(end - start + 1)}
+  if filename.endswith(PLAYLIST_EXTENSIONS):
+    headers['Cache-Control'] = 'no-cache'
+  status_code = 200
+  if byte_range is not None:
+    status_code = 206
+    headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+  if head:
+    return Response(status_code=status_code, media_type=media_type, headers=headers)
+  return StreamingResponse(read_range(path, start, end), status_code=status_code, media_type=media_type, headers=headers)
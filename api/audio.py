@@ -0,0 +1,188 @@
+# shared audio helpers
+# every synthesis method hands back mono 16-bit samples so the pipelines can
+# keep audio in memory and only touch disk when a file is actually needed
+import wave
+import numpy as np
+from api.progress import ProgressWriter
+
+SAMPLE_RATE = 44100
+
+# tones synthesis
+# reproduces what tones.Mixer does for our notes (1ms pitch glide steps, the
+# package's whole-sample waveform periods, attack/decay ramps) with numpy
+# array operations instead of building every note sample by sample
+NOTE_FREQUENCIES = np.array([261.625565301, 277.182630977, 293.664767918, 311.126983723, 329.627556913,
+                             349.228231433, 369.994422712, 391.995435982, 415.30469758, 440.0,
+                             466.163761518, 493.883301256]) # c .. b in octave 4, same table as tones
+TONES_AMPLITUDE = 0.5
+TONES_ATTACK = 0.01
+TONES_DECAY = 0.1
+PITCH_STEP = 0.001 # seconds between pitch changes during a glide
+NOTES_PER_CHUNK = 4096 # bounds the size of the float temporaries
+
+def _note_octaves(num_notes: int, diff: int = 2) -> np.ndarray:
+  # (octaves are 0 - 8 as per tones package)
+  # but skipping lowest 2 since you can't hear them and highest 2 since they sound bad
+  j = np.arange(num_notes)
+  return np.maximum(np.minimum(num_notes // 12, j // 12 + diff), j // 12 - diff)
+
+def map_notes(y, num_notes: int = 12 * 5):
+  """
+  Pick the start and end frequency of the glide played for every data point.
+
+  Returns the index of each point that gets a note plus the start and end
+  frequencies. Like the original loop, the last point and points equal to
+  the maximum (or nan) get no note.
+  """
+  y = np.asarray(y, dtype=float)
+  value_range = np.linspace(np.nanmin(y), np.nanmax(y), num_notes)
+  octaves = _note_octaves(num_notes)
+
+  # first note whose value is above the point
+  j = np.searchsorted(value_range, y, side='right')
+  points = np.arange(len(y) - 1)
+  j = j[:-1]
+  keep = j < num_notes
+  points, j = points[keep], j[keep]
+
+  # glide up a semitone while the data is rising, down a semitone otherwise
+  rising = (y[points + 1] > y[points]) & (j < num_notes - 1)
+  end_j = np.where(rising, j + 1, j - 1)
+
+  # the glide stays in the start note's octave (tones' endoctave default)
+  scale = np.power(2.0, octaves[j] - 4)
+  start_frequencies = NOTE_FREQUENCIES[j % 12] * scale
+  end_frequencies = NOTE_FREQUENCIES[end_j % 12] * scale
+  return points, start_frequencies, end_frequencies
+
+def synthesize_tones(y, fps: int, sample_rate: int = SAMPLE_RATE) -> np.ndarray:
+  points, start_frequencies, end_frequencies = map_notes(y)
+
+  # every note is split into 1ms steps with a fixed frequency each
+  note_samples = int((1 / fps) * sample_rate)
+  step_samples = int(PITCH_STEP * sample_rate)
+  exact_steps = note_samples / (PITCH_STEP * sample_rate)
+  num_steps = int(exact_steps)
+  samples_per_note = num_steps * step_samples
+  output = np.empty(len(points) * samples_per_note, dtype=np.int16)
+  if samples_per_note == 0 or len(points) == 0:
+    return output[:0]
+
+  # attack and decay ramps, the same for every note
+  ramp = np.arange(samples_per_note)
+  envelope = np.minimum(ramp / (sample_rate * TONES_ATTACK), 1.0) * np.minimum(ramp[::-1] / (sample_rate * TONES_DECAY), 1.0)
+
+  step = np.arange(num_steps)
+  phase = 0.0
+  for start in range(0, len(points), NOTES_PER_CHUNK):
+    end = min(start + NOTES_PER_CHUNK, len(points))
+    glide = (end_frequencies[start:end] - start_frequencies[start:end]) / exact_steps
+    frequencies = start_frequencies[start:end, None] + step * glide[:, None]
+    # tones plays back one whole-sample period of each frequency
+    frequencies = sample_rate / np.floor(sample_rate / frequencies)
+
+    # keep the phase continuous across steps, notes and chunks
+    increments = np.repeat(2 * np.pi * frequencies / sample_rate, step_samples, axis=1)
+    phases = phase + np.cumsum(increments, axis=None).reshape(increments.shape) - increments
+    phase = (phases[-1, -1] + increments[-1, -1]) % (2 * np.pi)
+
+    chunk = np.sin(phases) * envelope * TONES_AMPLITUDE
+    output[start * samples_per_note:end * samples_per_note] = np.clip(chunk * 32767, -32767, 32767).astype(np.int16).ravel()
+
+  return output
+
+def note_frequencies(note_indices, num_notes: int = 12 * 5) -> np.ndarray:
+  # frequency of each note index, in the same octaves map_notes uses
+  note_indices = np.asarray(note_indices)
+  return NOTE_FREQUENCIES[note_indices % 12] * np.power(2.0, _note_octaves(num_notes)[note_indices] - 4)
+
+def synthesize_notes(frequencies, amplitudes, note_seconds: float, sample_rate: int = SAMPLE_RATE,
+                     attack: float = TONES_ATTACK, decay: float = TONES_DECAY) -> np.ndarray:
+  """
+  One sine note per frequency, back to back, each note_seconds long and
+  scaled by its amplitude (0 - 1). Attack and decay are in seconds like
+  tones', but never take up more than half a note each.
+  """
+  frequencies = np.asarray(frequencies, dtype=np.float64)
+  amplitudes = np.asarray(amplitudes, dtype=np.float64)
+  samples_per_note = int(note_seconds * sample_rate)
+  output = np.empty(len(frequencies) * samples_per_note, dtype=np.int16)
+  if samples_per_note == 0 or len(frequencies) == 0:
+    return output[:0]
+
+  ramp = np.arange(samples_per_note)
+  attack_samples = max(1.0, min(attack, note_seconds / 2) * sample_rate)
+  decay_samples = max(1.0, min(decay, note_seconds / 2) * sample_rate)
+  envelope = np.minimum(ramp / attack_samples, 1.0) * np.minimum(ramp[::-1] / decay_samples, 1.0)
+
+  phase = 0.0
+  for start in range(0, len(frequencies), NOTES_PER_CHUNK):
+    end = min(start + NOTES_PER_CHUNK, len(frequencies))
+    increments = 2 * np.pi * frequencies[start:end] / sample_rate
+    # every note starts where the one before it left off, no clicks
+    note_phases = phase + np.concatenate(([0.0], np.cumsum(increments * samples_per_note)[:-1]))
+    phase = (note_phases[-1] + increments[-1] * samples_per_note) % (2 * np.pi)
+
+    chunk = np.sin(note_phases[:, None] + increments[:, None] * ramp) * envelope * amplitudes[start:end, None]
+    output[start * samples_per_note:end * samples_per_note] = (np.clip(chunk, -1, 1) * TONES_AMPLITUDE * 32767).astype(np.int16).ravel()
+
+  return output
+
+def synthesize_spectrogram(magnitudes, frequencies, fps: int, sample_rate: int = SAMPLE_RATE,
+                           overlap: int = 4) -> np.ndarray:
+  """
+  Additive synthesis through the inverse FFT: every row of magnitudes is
+  one video frame's amplitude for each of the given frequencies (as many
+  partials as there are columns). Frames are windowed and overlap added,
+  with each partial's phase carried across frames so steady partials stay
+  steady. Returns float samples, len(magnitudes) / fps seconds long.
+  """
+  magnitudes = np.asarray(magnitudes, dtype=np.float64)
+  num_frames = len(magnitudes)
+  hop = int(sample_rate / fps)
+  n_fft = hop * overlap
+  if num_frames == 0 or hop == 0:
+    return np.zeros(0)
+
+  # every partial lands on its nearest bin. low partials can share a bin,
+  # the matrix product adds them up
+  bins = np.clip(np.rint(np.asarray(frequencies) * n_fft / sample_rate).astype(np.int64), 1, n_fft // 2 - 1)
+  partial_bins = np.zeros((len(bins), n_fft // 2 + 1))
+  partial_bins[np.arange(len(bins)), bins] = 1.0
+  spectrum = magnitudes @ partial_bins
+
+  # frame f starts f * hop samples in, so bin b has turned 2 pi b f hop / n_fft
+  turns = np.outer(np.arange(num_frames), np.arange(n_fft // 2 + 1)) % overlap
+  frames = np.fft.irfft(spectrum * np.exp(2j * np.pi * turns / overlap), n=n_fft, axis=1)
+  # periodic hann windows at 1 / overlap hops add up to overlap / 2
+  window = 0.5 - 0.5 * np.cos(2 * np.pi * np.arange(n_fft) / n_fft)
+  frames *= window * (n_fft / 2) * (2 / overlap)
+
+  # overlap add, a quarter (1 / overlap) of every frame at a time
+  frames = frames.reshape(num_frames, overlap, hop)
+  output = np.zeros((num_frames + overlap - 1, hop))
+  for part in range(overlap):
+    output[part:part + num_frames] += frames[:, part]
+  output = output.ravel()
+
+  # centre each frame's window on its video frame
+  start = n_fft // 2 - hop // 2
+  return output[start:start + num_frames * hop]
+
+def normalize_samples(audio_data) -> np.ndarray:
+  # scale float audio to full range 16-bit PCM
+  audio_data = np.asarray(audio_data, dtype=np.float64).ravel()
+  audio_max = np.max(np.abs(audio_data)) if len(audio_data) else 0
+  if audio_max > 0:  # Avoid division by zero
+    audio_data = audio_data / audio_max
+  return (audio_data * 32767).astype(np.int16)
+
+def write_wav(path, samples: np.ndarray, sample_rate: int = SAMPLE_RATE):
+  # path can also be a file object
+  with wave.open(path, 'w') as wavefile:
+    wavefile.setnchannels(1)
+    wavefile.setsampwidth(2)
+    wavefile.setframerate(sample_rate)
+    wavefile.writeframes(samples.astype(np.int16).tobytes())
+  if isinstance(path, str):
+    ProgressWriter(path).update(force=True, audio_samples=len(samples), total_audio_samples=len(samples))
@@ -0,0 +1,73 @@
+# series downsampling
+# every data point becomes a video frame and a note, so long histories
+# (years of daily bars, months of minute bars) are reduced to a target number
+# of points first. both methods keep the shape of the line: peaks and dips
+# survive, unlike taking every nth point
+import numpy as np
+
+DOWNSAMPLE_METHODS = ('lttb', 'minmax')
+
+
+def lttb_indices(x, y, threshold: int) -> np.ndarray:
+  """
+  Largest Triangle Three Buckets. Keeps the first and last points and, from
+  each bucket in between, the point forming the largest triangle with the
+  point kept before it and the average of the next bucket.
+  """
+  n = len(y)
+  if threshold >= n or threshold < 3:
+    return np.arange(n)
+  x = np.asarray(x, dtype=np.float64)
+  y = np.asarray(y, dtype=np.float64)
+
+  # bucket edges for the n - 2 points between the first and the last
+  edges = (np.linspace(0, n - 2, threshold - 1)).astype(np.int64) + 1
+  # averages of every bucket up front, so the loop only does the area search
+  sums_x = np.add.reduceat(x[1:-1], edges[:-1] - 1)
+  sums_y = np.add.reduceat(y[1:-1], edges[:-1] - 1)
+  counts = np.diff(edges)
+  averages_x = np.append(sums_x / counts, x[-1])
+  averages_y = np.append(sums_y / counts, y[-1])
+
+  indices = np.empty(threshold, dtype=np.int64)
+  indices[0], indices[-1] = 0, n - 1
+  a = 0
+  for bucket in range(threshold - 2):
+    start, end = edges[bucket], edges[bucket + 1]
+    next_x, next_y = averages_x[bucket + 1], averages_y[bucket + 1]
+    # twice the triangle area, the constant factor doesn't change the argmax
+    areas = np.abs((x[a] - next_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (next_y - y[a]))
+    a = start + int(np.argmax(areas))
+    indices[bucket + 1] = a
+  return indices
+
+def minmax_indices(y, threshold: int) -> np.ndarray:
+  # the lowest and highest point of each of threshold / 2 buckets, in order
+  n = len(y)
+  num_buckets = threshold // 2
+  if threshold >= n or num_buckets < 1:
+    return np.arange(n)
+  buckets = np.arange(n) * num_buckets // n
+  # sorted by bucket then value, so a bucket's min is its first entry and its max its last
+  order = np.lexsort((y, buckets))
+  starts = np.searchsorted(buckets[order], np.arange(num_buckets), side='left')
+  ends = np.searchsorted(buckets[order], np.arange(num_buckets), side='right') - 1
+  return np.unique(np.concatenate((order[starts], order[ends])))
+
+def downsample(x, y, max_points: int, method: str = 'lttb'):
+  """
+  Reduce x and y to at most max_points points. Series that are already
+  short enough, or any series when max_points is None, come back untouched.
+  """
+  if max_points is None or len(y) <= max_points:
+    return x, y
+  # lttb always keeps the first, the last and one point in between
+  if max_points < 3:
+    raise ValueError(f'max_points must be at least 3, got {max_points}')
+  if method == 'lttb':
+    indices = lttb_indices(x, y, max_points)
+  elif method == 'minmax':
+    indices = minmax_indices(y, max_points)
+  else:
+    raise ValueError(f'unknown downsample method: {method}')
+  return x[indices], y[indices]
@@ -0,0 +1,101 @@
+# render worker pool
+# matplotlib, tones, moviepy, yfinance and requests all block, so every render
+# stage runs in a separate process and the event loop only awaits the result
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# how many renders run at once (defaults to one per core)
+RENDER_WORKERS = int(os.environ.get('SONIFY_RENDER_WORKERS', os.cpu_count() or 1))
+# how many renders may wait for a free worker before we start turning requests away
+RENDER_QUEUE_DEPTH = int(os.environ.get('SONIFY_RENDER_QUEUE_DEPTH', RENDER_WORKERS * 4))
+
+_executor = None
+_executor_lock = threading.Lock()
+_in_flight = 0
+_in_flight_lock = threading.Lock()
+_restarts = 0
+
+
+class RenderQueueFull(Exception):
+  pass
+
+
+def get_executor() -> ProcessPoolExecutor:
+  global _executor
+  with _executor_lock:
+    if _executor is None:
+      # spawn so workers don't inherit the server's threads and event loop
+      _executor = ProcessPoolExecutor(
+        max_workers=RENDER_WORKERS,
+        mp_context=multiprocessing.get_context('spawn'),
+      )
+    return _executor
+
+def restart_executor(broken: ProcessPoolExecutor):
+  # a worker died (out of memory, a crash in native code like surgepy) and
+  # took the pool with it. the next render gets a fresh pool. renders that
+  # fail on the same broken pool only replace it once
+  global _executor, _restarts
+  with _executor_lock:
+    if _executor is not broken:
+      return
+    _executor = None
+    _restarts += 1
+  print(f'render pool broke, restarting it (restart {_restarts})')
+  broken.shutdown(wait=False, cancel_futures=True)
+
+def get_pool_stats():
+  return {
+    'workers': RENDER_WORKERS,
+    'queue_depth': RENDER_QUEUE_DEPTH,
+    'in_flight': _in_flight,
+    'queued': max(0, _in_flight - RENDER_WORKERS),
+    'restarts': _restarts,
+  }
+
+def check_capacity():
+  # raises if another render would have to be turned away
+  if _in_flight >= RENDER_WORKERS + RENDER_QUEUE_DEPTH:
+    raise RenderQueueFull(f'render queue is full ({_in_flight} renders in flight)')
+
+def _release(future=None):
+  # runs in the pool's own thread once the worker is done with a render
+  global _in_flight
+  with _in_flight_lock:
+    _in_flight -= 1
+
+async def run_in_pool(func, *args):
+  # func and args get pickled, so func has to be a module level function
+  global _in_flight
+  with _in_flight_lock:
+    check_capacity()
+    _in_flight += 1
+
+  executor = get_executor()
+  try:
+    future = executor.submit(func, *args)
+  except BaseException as e:
+    _release()
+    if isinstance(e, BrokenProcessPool):
+      restart_executor(executor)
+    raise
+  # a render counts until its worker is done with it. cancelling the task
+  # awaiting it only drops a render that hasn't started, one that has keeps
+  # its worker busy until it next checks for the cancel marker
+  future.add_done_callback(_release)
+  try:
+    return await asyncio.wrap_future(future)
+  except BrokenProcessPool:
+    restart_executor(executor)
+    raise
+
+def shutdown_executor():
+  global _executor
+  with _executor_lock:
+    executor, _executor = _executor, None
+  if executor is not None:
+    executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,73 @@
+# parsed function cache
+# sympify and lambdify take tens of milliseconds and popular functions like
+# sin(x) come in over and over, so both results are kept in an LRU cache keyed
+# on the normalized function string. every process (server and render
+# workers) keeps its own cache
+import os
+import re
+import threading
+from collections import OrderedDict
+import sympy as sp
+
+EXPRESSION_CACHE_SIZE = int(os.environ.get('SONIFY_EXPRESSION_CACHE_SIZE', 256))
+
+X = sp.symbols('x')
+SYMPY_LOCALS = {'x': X, 'sin': sp.sin, 'cos': sp.cos, 'tan': sp.tan}
+
+
+def normalize_function(function: str) -> str:
+  # 'x * sin( x )' and 'x*sin(x)' are the same function, '2 3' and '23' aren't
+  return re.sub(r'\s*([^\w\s])\s*', r'\1', function).strip()
+
+
+class ExpressionCache:
+  def __init__(self, max_size: int = EXPRESSION_CACHE_SIZE):
+    self.max_size = max_size
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, function: str):
+    """
+    Parse and compile a function string, or return the cached result.
+
+    Returns the sympy expression and its numpy callable. Invalid functions
+    raise like sympify does and are not cached.
+    """
+    key = normalize_function(function)
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None:
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+      self.misses += 1
+
+    expression = sp.sympify(key, locals=SYMPY_LOCALS)
+    entry = (expression, sp.lambdify(X, expression, 'numpy'))
+
+    with self._lock:
+      self._entries[key] = entry
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.max_size:
+        self._entries.popitem(last=False)
+        self.evictions += 1
+    return entry
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+
+  def stats(self):
+    return {
+      'size': len(self._entries),
+      'max_size': self.max_size,
+      'hits': self.hits,
+      'misses': self.misses,
+      'evictions': self.evictions,
+    }
+
+
+expression_cache = ExpressionCache()
@@ -1,19 +1,48 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, UploadFile, File, Header, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+import asyncio
 import os
+from contextlib import asynccontextmanager
+from typing import Optional
 
-from api.utils import MathWaveSonificationConfig, StocksSonificationConfig
+from api.artifacts import serve_artifact
+from api.executor import RenderQueueFull, check_capacity, get_pool_stats, shutdown_executor
+from api.expressions import expression_cache
+from api.jobs import JobRunning, jobs
+from api.render_cache import render_cache
+from api.surge_remote import close_client
+from api.storage import close_storage, collect_garbage_forever, publish_artifact, storage
+from api.utils import (
+    MathWaveSonificationConfig, StocksSonificationConfig, ensure_job_id, new_job_id, output_filename,
+    audio_output_filename
+)
 from api.math_wave_sonification import (
     parse_function, create_animation, create_audio, create_surge_audio,
     combine_video_audio, delete_intermediate_files, math_wave_sonify
 )
 from api.stocks_sonification import (
     validate_ticker, create_stocks_animation, create_stocks_audio,
-    combine_stocks_video_audio, delete_intermediate_stocks_files
+    combine_stocks_video_audio, delete_intermediate_stocks_files, stocks_sonify
+)
+from api.translation_sonification import (
+    create_translation, delete_intermediate_translation_files, receive_translation, translate_upload,
+    translation_options
 )
-from api.translation_sonification import create_translation, delete_intermediate_translation_files
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+  # finished jobs are deleted once they expire, clients don't have to
+  gc_task = asyncio.create_task(collect_garbage_forever())
+  try:
+    yield
+  finally:
+    gc_task.cancel()
+    shutdown_executor()
+    await close_client()
+    await close_storage()
+
+app = FastAPI(lifespan=lifespan)
 origins = [
   'http://localhost:3000',
   'https://localhost:3000',
@@ -27,160 +56,323 @@ app.add_middleware(
   allow_headers=['*'],
 )
 
+
+@app.get('/health')
+async def health():
+  # renders happen in the worker pool, so this answers even while they run
+  return {'status': 'ok', 'renders': get_pool_stats(), 'expressions': expression_cache.stats(),
+          'render_cache': render_cache.stats(), 'jobs': jobs.stats()}
+
+@app.api_route('/animations/{job_id}/{filename}', methods=['GET', 'HEAD'])
+async def artifact(request: Request, job_id: str, filename: str, range: Optional[str] = Header(None)):
+  # same path next.js serves public/ under, with range requests, and
+  # streamed while a fragmented video is still being encoded. players and
+  # cdns probe with HEAD before asking for ranges
+  return serve_artifact(job_id, filename, range, head=request.method == 'HEAD')
+
+# statuses of one shot renders that produced their file
+RENDERED = ('Animation successful', 'Audio successful')
+
+async def publish_result(config):
+  # the video (or its hls / dash playlist), or with audio_only just the audio
+  if config.audio_only:
+    return {'audio': await publish_artifact(config.job_id, audio_output_filename(config.audio_format))}
+  return {'video': await publish_artifact(config.job_id, output_filename(config.output_format or 'mp4'))}
+
 # MATH STUFF
 @app.post('/math')
 async def math(config: MathWaveSonificationConfig):
+    job_id = ensure_job_id(config)
     try:
         res = await math_wave_sonify(config=config)
+        urls = await publish_result(config) if res['status'] in RENDERED else {'video': None}
+    except RenderQueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         print(f"Error: {e}")
-        return {"result": "fail"}
+        return {"result": "fail", "job_id": job_id, "error": str(e)}
 
-    return {"result": res['status'] }
+    return {"result": res['status'], "job_id": job_id, **urls}
 
 @app.post('/math/parse')
 async def parse(config: MathWaveSonificationConfig):
+  job_id = ensure_job_id(config)
   # parse function to make sure it's valid
   try:
     res = await parse_function(config=config)
   except Exception as e:
     print(f'error parsing function: {e}')
-    return {'status': 'fail'}
+    return {'status': 'fail', 'job_id': job_id, 'error': str(e)}
   
-  return {'status': 'success'}
+  return {'status': 'success', 'job_id': job_id}
 
 @app.post('/math/animation')
 async def animation(config: MathWaveSonificationConfig):
+  job_id = ensure_job_id(config)
   # create animation
   try:
     res = await create_animation(config=config)
+  except RenderQueueFull as e:
+    raise HTTPException(status_code=503, detail=str(e))
   except Exception as e:
     print(f'error creating animation: {e}')
-    return {'status': 'fail'}
+    return {'status': 'fail', 'job_id': job_id, 'error': str(e)}
   
-  return {'status': 'success'}
+  return {'status': 'success', 'job_id': job_id}
 
 @app.post('/math/audio')
 async def audio(config: MathWaveSonificationConfig):
+    job_id = ensure_job_id(config)
     try:
         res = await create_audio(config=config)
+    except RenderQueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         print(f'error creating audio: {e}')
-        return {'status': 'fail'}
+        return {'status': 'fail', 'job_id': job_id, 'error': str(e)}
     
-    return {'status': 'success'}
+    return {'status': 'success', 'job_id': job_id}
 
 @app.post('/math/combine')
 async def combine(config: MathWaveSonificationConfig):
+  job_id = ensure_job_id(config)
   # combine animation and audio
   try:
     res = await combine_video_audio(config=config)
+    video = await publish_artifact(job_id, output_filename(config.output_format or 'mp4'))
+  except RenderQueueFull as e:
+    raise HTTPException(status_code=503, detail=str(e))
   except Exception as e:
     print(f'error creating video: {e}')
-    return {'status': 'fail'}
+    return {'status': 'fail', 'job_id': job_id, 'error': str(e)}
   
-  return {'status': 'success'}
+  return {'status': 'success', 'job_id': job_id, 'video': video}
 
 @app.post('/math/delete')
 async def delete(config: MathWaveSonificationConfig):
+  job_id = config.job_id
   # delete all created files
   try:
     res = await delete_intermediate_files(config=config)
+    # no job id, nothing was published (and nothing to list under animations/None/)
+    if job_id:
+      await storage.delete(job_id)
   except Exception as e:
     print(f'error deleting videos: {e}')
-    return {'status': 'fail'}
+    return {'status': 'fail', 'job_id': job_id, 'error': str(e)}
 
-  return {'status': 'success'}
+  return {'status': 'success', 'job_id': job_id}
 
 @app.post('/math/surgeaudio')
 async def surge_audio(config: MathWaveSonificationConfig):
+  job_id = ensure_job_id(config)
   # create audio using surge
   try:
     res = await create_surge_audio(config=config)
+  except RenderQueueFull as e:
+    raise HTTPException(status_code=503, detail=str(e))
   except Exception as e:
     print(f'error creating audio: {e}')
-    return {'status': 'fail'}
+    return {'status': 'fail', 'job_id': job_id, 'error': str(e)}
   
-  return {'status': 'success'}
+  return {'status': 'success', 'job_id': job_id}
 
 
 # STOCK STUFF
+@app.post('/stocks')
+async def stocks(config: StocksSonificationConfig):
+  # download, animate, synthesize and combine in a single render
+  job_id = ensure_job_id(config)
+  try:
+    res = await stocks_sonify(config=config)
+    urls = await publish_result(config)
+  except RenderQueueFull as e:
+    raise HTTPException(status_code=503, detail=str(e))
+  except Exception as e:
+    print(f'error creating stocks sonification: {e}')
+    return {'status': 'fail', 'job_id': job_id, 'error': str(e)}
+
+  return {'status': 'success', 'job_id': job_id, **urls}
+
 @app.post('/stocks/ticker')
 async def ticker(config: StocksSonificationConfig):
+  job_id = ensure_job_id(config)
   # make sure ticker is valid
   try:
     res = await validate_ticker(config=config)
   except Exception as e:
     print(f'error with stock: {e}')
-    return {'status': 'fail'}
+    return {'status': 'fail', 'job_id': job_id, 'error': str(e)}
 
-  return {'status': 'success'}
+  return {'status': 'success', 'job_id': job_id}
 
 @app.post('/stocks/animation')
 async def stocks_animation(config: StocksSonificationConfig):
+  job_id = ensure_job_id(config)
   # create animation
   try:
     res = await create_stocks_animation(config=config)
+  except RenderQueueFull as e:
+    raise HTTPException(status_code=503, detail=str(e))
   except Exception as e:
     print(f'error creating animation: {e}')
-    return {'status': 'fail'}
+    return {'status': 'fail', 'job_id': job_id, 'error': str(e)}
   
-  return {'status': 'success'}
+  return {'status': 'success', 'job_id': job_id}
 
 @app.post('/stocks/audio')
 async def stocks_audio(config: StocksSonificationConfig):
+  job_id = ensure_job_id(config)
   # create audio with the appropriate method based on config
   try:
     print(f"Creating stocks audio with processing type: {config.audioProcessing if hasattr(config, 'audioProcessing') else 'default'}")
     res = await create_stocks_audio(config=config)
+  except RenderQueueFull as e:
+    raise HTTPException(status_code=503, detail=str(e))
   except Exception as e:
     print(f'error creating audio: {e}')
-    return {'status': 'fail'}
+    return {'status': 'fail', 'job_id': job_id, 'error': str(e)}
   
-  return {'status': 'success'}
+  return {'status': 'success', 'job_id': job_id}
 
 @app.post('/stocks/combine')
 async def stocks_combine(config: StocksSonificationConfig):
+  job_id = ensure_job_id(config)
   # combine animation and audio
   try:
     res = await combine_stocks_video_audio(config=config)
+    video = await publish_artifact(job_id, output_filename(config.output_format or 'mp4'))
+  except RenderQueueFull as e:
+    raise HTTPException(status_code=503, detail=str(e))
   except Exception as e:
     print(f'error creating video: {e}')
-    return {'status': 'fail'}
+    return {'status': 'fail', 'job_id': job_id, 'error': str(e)}
   
-  return {'status': 'success'}
+  return {'status': 'success', 'job_id': job_id, 'video': video}
 
 @app.post('/stocks/delete')
 async def delete_stocks(config: StocksSonificationConfig):
+  job_id = config.job_id
   # delete all created files
   try:
     res = await delete_intermediate_stocks_files(config=config)
+    # no job id, nothing was published (and nothing to list under animations/None/)
+    if job_id:
+      await storage.delete(job_id)
   except Exception as e:
     print(f'error deleting files: {e}')
-    return {'status': 'fail'}
+    return {'status': 'fail', 'job_id': job_id, 'error': str(e)}
   
-  return {'status': 'success'}
+  return {'status': 'success', 'job_id': job_id}
 
 
 # translation wave
 @app.post('/image/translation')
-async def translation(file: UploadFile = File(...)):
+async def translation(file: UploadFile = File(...), max_scanlines: Optional[int] = None, mode: Optional[str] = None,
+                      output_format: Optional[str] = None):
   # doing everything at once cuz lazy
   try:
-    res = await create_translation(file=file)
+    res = await create_translation(file=file, max_scanlines=max_scanlines, mode=mode, output_format=output_format)
+    video = await publish_artifact(res['job_id'], output_filename(output_format or 'mp4'))
+  except RenderQueueFull as e:
+    raise HTTPException(status_code=503, detail=str(e))
   except Exception as e:
     print(f'error creating translation sonification: {e}')
-    return {'status': 'fail'}
+    return {'status': 'fail', 'error': str(e)}
 
-  return {'status': 'success'}
+  return {'status': 'success', 'job_id': res['job_id'], 'video': video}
 
 @app.post('/image/delete')
-async def delete_translation():
+async def delete_translation(job_id: str):
   # delete all created files
   try:
-    res = await delete_intermediate_translation_files()
+    res = await delete_intermediate_translation_files(job_id)
+    # no job id, nothing was published (and nothing to list under animations/None/)
+    if job_id:
+      await storage.delete(job_id)
   except Exception as e:
     print(f'error deleting files: {e}')
-    return {'status': 'fail'}
+    return {'status': 'fail', 'error': str(e)}
   
-  return {'status': 'success'}
\ No newline at end of file
+  return {'status': 'success'}
+
+
+# BACKGROUND JOBS
+# same renders as /math, /stocks and /image/translation, but answered straight
+# away with a job id to poll or follow instead of holding the request open
+def submit_job(job_id: str, kind: str, coroutine):
+  try:
+    # turn the job away now rather than have it fail once it's running.
+    # jobs.submit counts the jobs already accepted, check_capacity the
+    # one shot renders holding a request open
+    check_capacity()
+    job = jobs.submit(job_id, kind, coroutine)
+  except RenderQueueFull as e:
+    coroutine.close()
+    raise HTTPException(status_code=503, detail=str(e))
+  except JobRunning as e:
+    raise HTTPException(status_code=409, detail=str(e))
+  except ValueError as e:
+    coroutine.close()
+    raise HTTPException(status_code=422, detail=str(e))
+  return {'job_id': job.job_id, 'status': job.status, 'status_url': f'/jobs/{job.job_id}',
+          'events_url': f'/jobs/{job.job_id}/events'}
+
+async def math_job(config: MathWaveSonificationConfig):
+  res = await math_wave_sonify(config=config)
+  if res['status'] not in RENDERED:
+    raise ValueError(f'could not parse function: {config.function}')
+  return await publish_result(config)
+
+async def stocks_job(config: StocksSonificationConfig):
+  await stocks_sonify(config=config)
+  return await publish_result(config)
+
+async def translation_job(job_id: str, upload_path: str, cache_key: str, max_scanlines: int, mode: str,
+                          output_format: str):
+  await translate_upload(job_id, upload_path, cache_key, max_scanlines, mode, output_format)
+  return {'video': await publish_artifact(job_id, output_filename(output_format))}
+
+@app.post('/jobs/math', status_code=202)
+async def submit_math(config: MathWaveSonificationConfig):
+  job_id = ensure_job_id(config)
+  return submit_job(job_id, 'math', math_job(config))
+
+@app.post('/jobs/stocks', status_code=202)
+async def submit_stocks(config: StocksSonificationConfig):
+  job_id = ensure_job_id(config)
+  return submit_job(job_id, 'stocks', stocks_job(config))
+
+@app.post('/jobs/translation', status_code=202)
+async def submit_translation(file: UploadFile = File(...), max_scanlines: Optional[int] = None, mode: Optional[str] = None,
+                             output_format: Optional[str] = None):
+  try:
+    max_scanlines, mode, output_format = translation_options(max_scanlines, mode, output_format)
+  except ValueError as e:
+    raise HTTPException(status_code=422, detail=str(e))
+  # the upload has to be read before the request ends
+  job_id = new_job_id()
+  upload_path, cache_key = await receive_translation(file, job_id, max_scanlines, mode)
+  return submit_job(job_id, 'translation', translation_job(job_id, upload_path, cache_key, max_scanlines, mode, output_format))
+
+def find_job(job_id: str):
+  job = jobs.get(job_id)
+  if job is None:
+    raise HTTPException(status_code=404, detail=f'unknown job: {job_id}')
+  return job
+
+@app.get('/jobs/{job_id}')
+async def job_status(job_id: str):
+  return find_job(job_id).snapshot()
+
+@app.get('/jobs/{job_id}/events')
+async def job_events(job_id: str):
+  find_job(job_id)
+  return StreamingResponse(jobs.events(job_id), media_type='text/event-stream',
+                           headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.delete('/jobs/{job_id}')
+async def cancel_job(job_id: str):
+  find_job(job_id)
+  job = await jobs.cancel(job_id)
+  return job.snapshot()
@@ -0,0 +1,218 @@
+# background render jobs
+# a one shot render can be submitted as a job instead of holding the request
+# open: the server answers with the job id straight away and runs the render
+# as a task on its own event loop (the heavy lifting still happens in the
+# render pool). clients poll GET /jobs/<id> or listen to the server sent
+# events at /jobs/<id>/events, and DELETE /jobs/<id> cancels.
+# with several server processes (uvicorn --workers) those requests can land
+# on a process that didn't take the job, so every job keeps its status and
+# result in .job.json in its directory, next to the progress files, and any
+# process can answer from there. a cancel from another process drops the
+# .cancel marker, which the render notices at its next progress update
+import asyncio
+import json
+import os
+import time
+from api.executor import RENDER_QUEUE_DEPTH, RENDER_WORKERS, RenderQueueFull
+from api.progress import JobCancelled, clear_cancel, read_progress, request_cancel
+from api.utils import OUTPUT_DIR, JOB_ID_PATTERN, get_job_dir
+
+JOB_TTL = int(os.environ.get('SONIFY_JOB_TTL', 60 * 60)) # seconds finished jobs can still be looked up
+JOB_EVENT_INTERVAL = 0.5 # seconds between progress events
+JOB_FILENAME = '.job.json'
+
+FINISHED = ('succeeded', 'failed', 'cancelled')
+# what .job.json holds
+RECORD_FIELDS = ('job_id', 'kind', 'status', 'result', 'error', 'created', 'finished', 'pid')
+
+
+class JobRunning(Exception):
+  pass
+
+
+def job_path(job_id: str) -> str:
+  return os.path.join(OUTPUT_DIR, job_id, JOB_FILENAME)
+
+def process_alive(pid: int) -> bool:
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    return True
+  return True
+
+
+class Job:
+  def __init__(self, job_id: str, kind: str, status: str = 'running', result=None, error=None,
+               created: float = None, finished: float = None, pid: int = None):
+    self.job_id = job_id
+    self.kind = kind
+    self.status = status
+    self.result = result
+    self.error = error
+    self.created = created or time.time()
+    self.finished = finished
+    # the server process running the job
+    self.pid = pid or os.getpid()
+    self.task = None
+
+  @property
+  def done(self) -> bool:
+    return self.status in FINISHED
+
+  @property
+  def orphaned(self) -> bool:
+    # the process running it is gone (restarted or crashed) without finishing it
+    return not self.done and not process_alive(self.pid)
+
+  def snapshot(self):
+    return {
+      'job_id': self.job_id,
+      'kind': self.kind,
+      'status': self.status,
+      # frames, total_frames, audio_samples, total_audio_samples, mux_percent
+      'progress': read_progress(os.path.join(OUTPUT_DIR, self.job_id)),
+      'result': self.result,
+      'error': self.error,
+      'created': self.created,
+      'finished': self.finished,
+    }
+
+  def save(self):
+    path = job_path(self.job_id)
+    temp_path = f'{path}.tmp'
+    try:
+      with open(temp_path, 'w') as f:
+        json.dump({field: getattr(self, field) for field in RECORD_FIELDS}, f)
+      os.replace(temp_path, path)
+    except FileNotFoundError:
+      pass # the job directory was deleted while the job ran
+
+  @classmethod
+  def load(cls, job_id: str):
+    # the job as last saved by whichever process runs it, or None
+    if not JOB_ID_PATTERN.match(job_id or ''):
+      return None
+    try:
+      with open(job_path(job_id)) as f:
+        return cls(**json.load(f))
+    except (OSError, ValueError, TypeError):
+      return None
+
+
+class JobManager:
+  def __init__(self, ttl: int = JOB_TTL, capacity: int = RENDER_WORKERS + RENDER_QUEUE_DEPTH):
+    self.ttl = ttl
+    # jobs accepted and not finished yet, whether they are rendering or
+    # still receiving their upload, fetching from the cache or remote surge
+    self.capacity = capacity
+    self._jobs = {}
+
+  def submit(self, job_id: str, kind: str, coroutine) -> Job:
+    """Run coroutine (whose result becomes the job's result) in the background."""
+    self._expire()
+    existing = self._jobs.get(job_id) or Job.load(job_id)
+    if existing is not None and not existing.done and not existing.orphaned:
+      coroutine.close()
+      raise JobRunning(f'job {job_id} is already running')
+    if self.active() >= self.capacity:
+      coroutine.close()
+      raise RenderQueueFull(f'render queue is full ({self.active()} jobs running)')
+
+    # a cancelled earlier job with this id mustn't stop this one
+    clear_cancel(get_job_dir(job_id))
+    job = Job(job_id, kind)
+    job.save()
+    job.task = asyncio.create_task(self._run(job, coroutine))
+    job.task.add_done_callback(lambda task: self._cancelled_before_start(job, coroutine))
+    self._jobs[job_id] = job
+    return job
+
+  def _cancelled_before_start(self, job: Job, coroutine):
+    # a task cancelled before its first step never enters _run's try
+    if job.done:
+      return
+    coroutine.close()
+    job.status = 'cancelled'
+    job.finished = time.time()
+    job.save()
+
+  async def _run(self, job: Job, coroutine):
+    try:
+      job.result = await coroutine
+      job.status = 'succeeded'
+    except (asyncio.CancelledError, JobCancelled):
+      job.status = 'cancelled'
+    except Exception as e:
+      print(f'error in {job.kind} job {job.job_id}: {e}')
+      job.status = 'failed'
+      job.error = f'{type(e).__name__}: {e}'
+    finally:
+      job.finished = time.time()
+      job.save()
+
+  def get(self, job_id: str) -> Job:
+    # jobs this process runs are looked up in memory, other processes' jobs
+    # from their .job.json
+    job = self._jobs.get(job_id)
+    if job is not None:
+      return job
+    job = Job.load(job_id)
+    if job is None:
+      return None
+    if job.orphaned:
+      job.status = 'failed'
+      job.error = 'the server process running the job exited'
+      job.finished = time.time()
+    elif job.done and time.time() - job.finished > self.ttl:
+      return None
+    return job
+
+  async def cancel(self, job_id: str) -> Job:
+    job = self.get(job_id)
+    if job is None or job.done:
+      return job
+    # stages already running in a worker see the marker at their next
+    # progress update and kill their ffmpeg. stages still waiting for a
+    # worker are dropped with the task
+    request_cancel(os.path.join(OUTPUT_DIR, job_id))
+    if job.task is None:
+      # another process runs it and marks it cancelled once its render stops
+      return job
+    job.task.cancel()
+    await asyncio.wait([job.task])
+    return job
+
+  async def events(self, job_id: str):
+    # server sent events: a progress event whenever something changed, then
+    # one final event with the finished job
+    last = None
+    while True:
+      job = self.get(job_id)
+      if job is None:
+        return
+      snapshot = job.snapshot()
+      if job.done:
+        yield f'event: {job.status}\ndata: {json.dumps(snapshot)}\n\n'
+        return
+      if snapshot != last:
+        yield f'event: progress\ndata: {json.dumps(snapshot)}\n\n'
+        last = snapshot
+      await asyncio.sleep(JOB_EVENT_INTERVAL)
+
+  def _expire(self):
+    now = time.time()
+    for job_id, job in list(self._jobs.items()):
+      if job.done and now - job.finished > self.ttl:
+        del self._jobs[job_id]
+
+  def active(self) -> int:
+    return sum(not job.done for job in self._jobs.values())
+
+  def stats(self):
+    statuses = [job.status for job in self._jobs.values()]
+    return {status: statuses.count(status) for status in ('running',) + FINISHED}
+
+
+jobs = JobManager()
@@ -0,0 +1,242 @@
+# stock price history
+# the stocks pipeline asks a data source for a ticker's OHLCV history. two
+# sources ship:
+#   yfinance - live downloads, cached with a TTL so every stage (and every
+#              render worker on the box) reuses the same download
+#   local    - a columnar store on disk, bulk loaded from CSV, that needs no
+#              network access. renders against it are reproducible
+# both keep history as one memory mapped .npy file per column, so slicing a
+# date range out of it never copies
+import abc
+import argparse
+import csv
+import os
+import shutil
+import time
+import uuid
+from typing import NamedTuple
+import numpy as np
+
+MARKET_DATA_DIR = os.environ.get('SONIFY_MARKET_DATA_DIR', 'market_data')
+MARKET_DATA_TTL = int(os.environ.get('SONIFY_MARKET_DATA_TTL', 15 * 60)) # seconds
+MARKET_DATA_SOURCE = os.environ.get('SONIFY_MARKET_DATA_SOURCE', 'yfinance')
+LOCAL_STORE_DIR = os.environ.get('SONIFY_LOCAL_STORE_DIR', os.path.join(MARKET_DATA_DIR, 'local'))
+
+COLUMNS = ('dates', 'open', 'high', 'low', 'close', 'volume')
+# periods yahoo accepts as is, anything else (e.g. 400d) becomes a start date
+YFINANCE_PERIODS = ('1d', '5d', '1mo', '3mo', '6mo', '1y', '2y', '5y', '10y', 'ytd', 'max')
+
+
+class PriceHistory(NamedTuple):
+  dates: np.ndarray # datetime64[s]
+  open: np.ndarray
+  high: np.ndarray
+  low: np.ndarray
+  close: np.ndarray
+  volume: np.ndarray
+
+  def slice(self, start=None, end=None) -> 'PriceHistory':
+    # dates are sorted, so a date range is a contiguous (zero copy) slice
+    i = 0 if start is None else np.searchsorted(self.dates, np.datetime64(start, 's'), side='left')
+    j = len(self.dates) if end is None else np.searchsorted(self.dates, np.datetime64(end, 's'), side='right')
+    return PriceHistory(*(column[i:j] for column in self))
+
+
+class ColumnarStore:
+  # <root>/<KEY>/<column>.npy
+  def __init__(self, root: str):
+    self.root = root
+
+  def _dir(self, key: str) -> str:
+    return os.path.join(self.root, key)
+
+  def age(self, key: str) -> float:
+    # seconds since the key was written, raises if it doesn't exist
+    return time.time() - os.path.getmtime(os.path.join(self._dir(key), 'close.npy'))
+
+  def read(self, key: str) -> PriceHistory:
+    directory = self._dir(key)
+    return PriceHistory(*(np.load(os.path.join(directory, f'{column}.npy'), mmap_mode='r') for column in COLUMNS))
+
+  def write(self, key: str, history: PriceHistory):
+    # write everything next to the real directory and swap it in, so readers
+    # in other processes never see half a history
+    os.makedirs(self.root, exist_ok=True)
+    temp_dir = self._dir(f'{key}.{uuid.uuid4().hex}.tmp')
+    os.makedirs(temp_dir)
+    for column, values in zip(COLUMNS, history):
+      np.save(os.path.join(temp_dir, f'{column}.npy'), np.ascontiguousarray(values))
+
+    old_dir = None
+    if os.path.exists(self._dir(key)):
+      old_dir = self._dir(f'{key}.{uuid.uuid4().hex}.old')
+      os.replace(self._dir(key), old_dir)
+    os.replace(temp_dir, self._dir(key))
+    if old_dir:
+      shutil.rmtree(old_dir, ignore_errors=True)
+
+  def keys(self):
+    if not os.path.isdir(self.root):
+      return []
+    return sorted(name for name in os.listdir(self.root) if not name.endswith(('.tmp', '.old')))
+
+
+def period_start(last_date, period: str):
+  # yfinance style periods (5d, 6mo, 2y, ytd, max) measured back from last_date
+  if period in (None, '', 'max'):
+    return None
+  last_date = np.datetime64(last_date, 'D')
+  if period == 'ytd':
+    return last_date.astype('datetime64[Y]').astype('datetime64[D]')
+  units = {'d': 1, 'wk': 7, 'mo': 30.44, 'y': 365.25}
+  for unit, days in units.items():
+    if period.endswith(unit) and period[:-len(unit)].isdigit():
+      return last_date - np.timedelta64(int(round(int(period[:-len(unit)]) * days)), 'D')
+  raise ValueError(f'unsupported period: {period}')
+
+
+class MarketDataSource(abc.ABC):
+  name = ''
+
+  @abc.abstractmethod
+  def get_history(self, ticker: str, period: str = '2y', start=None, end=None, interval: str = '1d') -> PriceHistory:
+    # start (a date or datetime) takes precedence over period, which is
+    # otherwise measured back from end (or the latest bar)
+    ...
+
+
+class YFinanceSource(MarketDataSource):
+  name = 'yfinance'
+
+  def __init__(self, cache_dir: str = os.path.join(MARKET_DATA_DIR, 'yfinance'), ttl: int = MARKET_DATA_TTL):
+    self.cache = ColumnarStore(cache_dir)
+    self.ttl = ttl
+    self._memory = {}
+
+  def download(self, ticker: str, period: str, start=None, end=None, interval: str = '1d') -> PriceHistory:
+    # imported here so the local source works where yfinance isn't installed
+    import yfinance as yf
+
+    if start is None and (end is not None or period not in YFINANCE_PERIODS):
+      start = period_start(np.datetime64('today') if end is None else end, period)
+      start = None if start is None else str(start)
+
+    # ['Open', 'High', 'Low', 'Close', 'Volume', 'Dividends', 'Stock Splits']
+    if start is not None or end is not None:
+      hist = yf.Ticker(ticker).history(start=start, end=end, interval=interval)
+    else:
+      hist = yf.Ticker(ticker).history(period=period, interval=interval)
+    if len(hist) == 0:
+      raise ValueError(f'no price history for {ticker}')
+    dates = hist.index.tz_localize(None) if hist.index.tz is not None else hist.index
+    return PriceHistory(
+      dates.to_numpy(dtype='datetime64[s]'),
+      *(hist[column].to_numpy(dtype=np.float64) for column in ('Open', 'High', 'Low', 'Close', 'Volume'))
+    )
+
+  def get_history(self, ticker: str, period: str = '2y', start=None, end=None, interval: str = '1d') -> PriceHistory:
+    if start is not None:
+      key = f'{ticker.upper()}_{interval}_{start}_{end}'
+    else:
+      key = f'{ticker.upper()}_{interval}_{period}_{end}'
+    # no ':' in directory names on windows
+    key = key.replace(':', '').replace(' ', 'T')
+    now = time.time()
+
+    cached = self._memory.get(key)
+    if cached is not None and now - cached[0] < self.ttl:
+      return cached[1]
+
+    try:
+      if self.cache.age(key) < self.ttl:
+        history = self.cache.read(key)
+        self._memory[key] = (now, history)
+        return history
+    except (OSError, ValueError):
+      pass
+
+    self.cache.write(key, self.download(ticker, period, start, end, interval))
+    # read back memory mapped (and read only) like every other history
+    history = self.cache.read(key)
+    self._memory[key] = (now, history)
+    return history
+
+
+class LocalStoreSource(MarketDataSource):
+  name = 'local'
+
+  def __init__(self, store_dir: str = LOCAL_STORE_DIR):
+    self.store = ColumnarStore(store_dir)
+
+  @staticmethod
+  def store_key(ticker: str, interval: str = '1d') -> str:
+    # daily bars are stored under the bare ticker, other intervals next to them
+    return ticker.upper() if interval == '1d' else f'{ticker.upper()}_{interval}'
+
+  def get_history(self, ticker: str, period: str = '2y', start=None, end=None, interval: str = '1d') -> PriceHistory:
+    try:
+      history = self.store.read(self.store_key(ticker, interval))
+    except FileNotFoundError:
+      raise ValueError(f'{ticker} ({interval}) is not in the local store')
+    if start is None and len(history.dates):
+      start = period_start(history.dates[-1] if end is None else end, period)
+    return history.slice(start, end)
+
+  def bulk_load_csv(self, csv_path: str, ticker: str = None, interval: str = '1d'):
+    """
+    Load a CSV with Date (or Datetime), Open, High, Low, Close, Volume columns
+    (what Yahoo and yfinance export) into the store. Files holding several
+    tickers need a Ticker column; single ticker files can pass ticker instead.
+    """
+    rows = {}
+    with open(csv_path, newline='') as f:
+      for row in csv.DictReader(f):
+        symbol = (row.get('Ticker') or ticker or '').upper()
+        if not symbol:
+          raise ValueError('csv has no Ticker column, pass ticker')
+        rows.setdefault(symbol, []).append(row)
+
+    for symbol, symbol_rows in rows.items():
+      # timezone offsets dropped, same as the yfinance source
+      dates = np.array([(row.get('Date') or row['Datetime'])[:19] for row in symbol_rows], dtype='datetime64[s]')
+      order = np.argsort(dates, kind='stable')
+      columns = [np.array([float(row[name] or 'nan') for row in symbol_rows])[order]
+                 for name in ('Open', 'High', 'Low', 'Close', 'Volume')]
+      self.store.write(self.store_key(symbol, interval), PriceHistory(dates[order], *columns))
+    return sorted(rows)
+
+
+DATA_SOURCES = {
+  YFinanceSource.name: YFinanceSource,
+  LocalStoreSource.name: LocalStoreSource,
+}
+_sources = {}
+
+def get_data_source(name: str = None) -> MarketDataSource:
+  name = name or MARKET_DATA_SOURCE
+  if name not in DATA_SOURCES:
+    raise ValueError(f'unknown market data source: {name}')
+  if name not in _sources:
+    _sources[name] = DATA_SOURCES[name]()
+  return _sources[name]
+
+def get_close_prices(ticker: str, period: str = '2y', source: str = None, start=None, end=None,
+                     interval: str = '1d') -> np.ndarray:
+  close = get_data_source(source).get_history(ticker, period, start, end, interval).close
+  if len(close) == 0:
+    raise ValueError(f'no price history for {ticker}')
+  return close
+
+
+if __name__ == '__main__':
+  # python -m api.market_data prices.csv --ticker SPY
+  parser = argparse.ArgumentParser(description='bulk load CSV price history into the local market data store')
+  parser.add_argument('csv_paths', nargs='+')
+  parser.add_argument('--ticker', help='ticker for single ticker files without a Ticker column')
+  parser.add_argument('--interval', default='1d', help='bar interval of the files, e.g. 1m or 1h')
+  parser.add_argument('--store', default=LOCAL_STORE_DIR)
+  args = parser.parse_args()
+
+  source = LocalStoreSource(args.store)
+  for csv_path in args.csv_paths:
+    print(f'loaded {", ".join(source.bulk_load_csv(csv_path, args.ticker, args.interval))} from {csv_path}')
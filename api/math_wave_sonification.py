@@ -1,21 +1,26 @@
 import numpy as np
 import sympy as sp
 import os
-import matplotlib.pyplot as plt
-import matplotlib.animation as animation
-from tones import SINE_WAVE
-from tones.mixer import Mixer
-from moviepy.editor import VideoFileClip, AudioFileClip
-from api.utils import MathWaveSonificationConfig
-from pathlib import Path
-import requests
+from api.audio import SAMPLE_RATE, synthesize_tones, normalize_samples, write_wav
+from api.executor import run_in_pool
+from api.expressions import X, expression_cache, normalize_function
+from api.media import combine_files, render_audio_only, segment_video
+from api.plotting import save_line_animation
+from api.render_cache import render_cache, sonification_cache_key
+from api.segments import render_segmented
+from api.surge import import_surgepy, render_pitch_track, surge_pool
+from api.surge_remote import SURGE_REMOTE_URL, fetch_remote_audio
+from api.raster import save_raster_line_animation
+from api.utils import (
+    MathWaveSonificationConfig, ANIMATION_FILENAME, AUDIO_FILENAME, VIDEO_FILENAME,
+    ensure_job_id, get_job_file, delete_job_dir, output_filename, audio_output_filename
+)
 
 # surge imports
 """import sys
 sys.path.append('surge/ignore/bpy/src/surge-python')
 import surgepy
 from surgepy import constants as srgco"""
-import wave
 
 def grab_patch(surge_path):
     """
@@ -102,228 +107,133 @@ def grab_patch(surge_path):
     return "Not Found"
     
 # step 1. parse function
-async def parse_function(config: MathWaveSonificationConfig):
-  X = sp.symbols('x')
-  function = sp.sympify(config.function, locals={'x': X, 'sin': sp.sin, 'cos': sp.cos, 'tan': sp.tan})
+def parse_expression(config: MathWaveSonificationConfig):
+  # cached, so every step and every repeat request after the first is free
+  function, np_function = expression_cache.get(config.function)
   return X, function
 
-# step 2. create animation
-async def create_animation(config: MathWaveSonificationConfig):
-  # guaranteed to work now
-  X, function = await parse_function(config=config)
+async def parse_function(config: MathWaveSonificationConfig):
+  return parse_expression(config)
 
+def evaluate_function(config: MathWaveSonificationConfig):
+  # sample the function once. every stage below works off these arrays
+  function, np_function = expression_cache.get(config.function)
   x = np.linspace(config.x_range_start, config.x_range_end, config.num_data_points)
-  np_function = sp.lambdify(X, function, 'numpy')
   y = np_function(x)
- 
-  # save animation
-  fig = plt.figure()
-  fig.suptitle(f'{config.title}')
-  plt.xlabel(config.x_label)
-  plt.ylabel(config.y_label)
-  plt.grid()
-  plt.ylim((min(y) - 1, max(y) + 1))
-  
-  def animate(n):
-    line, = plt.plot(x[:n], y[:n], color=config.graph_color)
-    return line,
-  
-  fps = config.fps
-  frames = len(y)
-  interval = 1000 /fps
- 
-  ani = animation.FuncAnimation(fig=fig, func=animate, frames=frames, interval=interval, blit=True)
-  Writer = animation.writers['ffmpeg']
-  writer = Writer(fps=fps, metadata=dict(artist='Me'), bitrate=1800)
-
-  # make sure directory exists
-  output_dir = 'public/animations'
-  os.makedirs(output_dir, exist_ok=True)
-  file_path = os.path.join(output_dir, 'animation.mp4')
-  ani.save(file_path, writer=writer)
-  plt.close(fig)
-  return {'status': 'success'}
+  return x, y
 
-# step 3. create audio with tones
-async def create_tones_audio(config: MathWaveSonificationConfig):
-  X, function = await parse_function(config=config)
-  x = np.linspace(config.x_range_start, config.x_range_end, config.num_data_points)
-  np_function = sp.lambdify(X, function, 'numpy')
-  y = np_function(x)
-  output_dir = 'public/animations'
-  video_time = len(y) / config.fps
-
-  # generate audio
-  diff = 2
-  notes = ['c', 'c#', 'd', 'd#', 'e', 'f', 'f#', 'g', 'g#', 'a', 'a#', 'b'] * (9 - 2 * diff)
-  # (octaves are 0 - 8 as per tones package)
-  # but skipping lowest 2 since you can't hear them and highest 2 since they sound bad
-
-  num_notes = len(notes)
-  min_value = min(y)
-  max_value = max(y)
-  value_range = np.linspace(min_value, max_value, num_notes)
-  mixer = Mixer(44100, 0.5)
-  mixer.create_track(0, SINE_WAVE, attack=0.01, decay=0.1)
-
-  def clamp(j, diff): # returns inner values (diff inside 9)
-    return max(min(len(notes) // 12, j // 12 + diff), j // 12 - diff)
-
-  for i, value in enumerate(y):
-    for j, v in enumerate(value_range):
-      if value < v:
-        if i < len(y) - 1:
-          if y[i + 1] > y[i] and j < len(value_range) - 1:
-            mixer.add_note(0, note=notes[j], octave=clamp(j, diff), duration=video_time / len(y), endnote=notes[j + 1])
-          else:
-            mixer.add_note(0, note=notes[j], octave=clamp(j, diff), duration=video_time / len(y), endnote=notes[j - 1])
-        break
-  
-  mixer.write_wav(output_dir + '/tones.wav')
-  return {'status': 'success'}
-async def create_surge_audio_local(config):
-    # Try to import Surge only when this function is called
-    try:
-        import sys
-        import os
-        
-        # Use the path provided in the request
-        if hasattr(config, 'surgePath') and config.surgePath:
-            surge_path = config.surgePath
-            # Clean and normalize the path
-            surge_path = os.path.normpath(surge_path)
-            
-            # Add to Python path if it exists
-            if os.path.exists(surge_path):
-                sys.path.append(surge_path)
-                print(f"Added surge path to system: {surge_path}")
-            else:
-                print(f"Warning: Provided surge path does not exist: {surge_path}")
-            
-        # Now try to import Surge
-        import surgepy
-        from surgepy import constants as srgco
-        
-        X, function = await parse_function(config=config)
-        x = np.linspace(config.x_range_start, config.x_range_end, config.num_data_points)
-        np_function = sp.lambdify(X, function, 'numpy')
-        y = np_function(x)
-        video_time = len(y) / config.fps
-        sample_rate = 44100
+# step 2. create animation
+def save_animation(config: MathWaveSonificationConfig, x, y, file_path: str, audio_path: str = None,
+                   start: int = 0, end: int = None):
+  # with audio_path the audio is muxed in by the same ffmpeg process
+  save = save_raster_line_animation if config.animation_engine == 'fast' else save_line_animation
+  save(x, y, file_path, f'{config.title}', config.x_label, config.y_label, config.graph_color,
+       config.fps, ylim=(min(y) - 1, max(y) + 1), audio_path=audio_path, start=start, end=end)
+
+# render_* functions do the blocking work and run inside the render pool
+def render_animation_segment(config: MathWaveSonificationConfig, x, y, file_path: str, start: int, end: int):
+  save_animation(config, x, y, file_path, start=start, end=end)
+
+async def create_animation(config: MathWaveSonificationConfig):
+  # long animations are rendered in segments on several workers at once
+  job_id = ensure_job_id(config)
+  x, y = await run_in_pool(evaluate_function, config)
+  return await render_segmented(render_animation_segment, (config, x, y), len(y), get_job_file(job_id, ANIMATION_FILENAME))
+
+# step 3. create audio
+# synthesize_* functions turn the sampled function into 16-bit samples
+# grab_patch walks the filesystem, so remember where it found the patch
+_patch_paths = {}
+
+def find_patch(surge_path):
+    if surge_path not in _patch_paths:
+        print(f"Finding patch from path: {surge_path}")
+        patch_path = grab_patch(surge_path)
+        if patch_path == "Not Found":
+            # not cached, the patch may be installed later
+            print("No patch found, using default")
+            return None
+        _patch_paths[surge_path] = patch_path
+    return _patch_paths[surge_path]
+
+def synthesize_surge_local(config, y):
+    surgepy = import_surgepy(config.surgePath)
+    patch_path = find_patch(config.surgePath) if config.surgePath else None
     
-        print("Creating Surge instance...")
-        surge = surgepy.createSurge(sample_rate)
-        
-        # Try to load a patch
-        if hasattr(config, 'surgePath') and config.surgePath:
-            print(f"Finding patch from path: {config.surgePath}")
-            patch_path = grab_patch(config.surgePath)
-            
-            if patch_path != "Not Found":
-                try:
-                    print(f"Loading patch from: {patch_path}")
-                    surge.loadPatch(patch_path)
-                    print("Patch loaded successfully")
-                except Exception as e:
-                    print(f"Error loading patch: {e}")
-            else:
-                print("No patch found, using default")
-        
-        # Continue with pitch configuration
-        cg_Global = surge.getControlGroup(srgco.cg_GLOBAL)
-        globalEnts = cg_Global.getEntries()
-        globalPar = globalEnts[1].getParams()
-        pitch = globalPar[1]  # global scene pitch parameter
-        
-        min_value = min(y)
-        max_value = max(y)
-        value_range = max_value - min_value
-        normalized_values = [(v - min_value) / value_range for v in y]  # normalize to 0-1 scale
-        
-        # Calculate blocks needed for audio
-        blocks_per_frame = int(sample_rate // config.fps // surge.getBlockSize()) 
-        total_samples = int(np.ceil(video_time * sample_rate))
-        
-        # Calculate number of blocks needed and create the audio data array
-        num_blocks = (total_samples + surge.getBlockSize() - 1) // surge.getBlockSize()
-        audio_data = np.zeros((num_blocks, surge.getBlockSize()))
-        
-        print(f"Generating audio with {len(normalized_values)} frames...")
-        surge.playNote(0, 60, 127, 0)  # Middle C Midi = pressed
-        pos = 0
-        
-        # Generate audio blocks
-        for i, value in enumerate(normalized_values):
-            pitch_bend_amount = value * 14 - 7  # scale to middle of (-7 ... +7)
-            surge.setParamVal(pitch, pitch_bend_amount)
-            
-            for _ in range(blocks_per_frame):
-                if pos >= len(audio_data):
-                    break  # Prevent index out of bounds
-                    
-                surge.process()
-                audio_data[pos, :] = surge.getOutput()[0, :]
-                pos += 1
-                
-        surge.releaseNote(0, 60, 0)  # release Middle C
-        
-        # Normalize and convert to 16-bit PCM
-        audio_max = np.max(np.abs(audio_data))
-        if audio_max > 0:  # Avoid division by zero
-            audio_data /= audio_max
-        audio_data = (audio_data * 32767).astype(np.int16)
-
-        output_filename = 'public/animations/tones.wav'
-        with wave.open(output_filename, 'w') as wavefile:
-            wavefile.setnchannels(1) 
-            wavefile.setsampwidth(2)   
-            wavefile.setframerate(44100)
-            wavefile.writeframes(audio_data.tobytes())
-
-        print("Audio generation completed successfully")
-        return {'status': 'success'}
-    except ImportError as error:
-        print(f"Failed to import Surge: {error}")
-        print("Falling back to tones")
-        return await create_tones_audio(config)
+    # pitch follows the data, one frame of audio per point
+    with surge_pool.acquire(surgepy, SAMPLE_RATE, patch_path) as instance:
+        print(f"Generating audio with {len(y)} frames...")
+        audio_data = render_pitch_track(instance.surge, instance.pitch, y, config.fps, instance.sample_rate)
+    
+    # Normalize and convert to 16-bit PCM
+    print("Audio generation completed successfully")
+    return normalize_samples(audio_data)
+
+# the remote server is called from the event loop (see api/surge_remote.py)
+# before any render work is queued. it writes the job's wav itself
+async def fetch_surge_audio_remote(config: MathWaveSonificationConfig, remote_url=None):
+    """Download the remote Surge render into the job directory. Returns False if tones should be used instead."""
+    # Prepare the data
+    data = {
+        "function": config.function,
+        "x_range_start": config.x_range_start,
+        "x_range_end": config.x_range_end,
+        "num_data_points": config.num_data_points,
+        "fps": config.fps
+    }
+    
+    try:
+        await fetch_remote_audio(remote_url or config.remoteURL, "math_audio", data,
+                                 get_job_file(ensure_job_id(config), AUDIO_FILENAME))
+        return True
     except Exception as e:
-        print(f"Error during surge audio generation: {e}")
+        print(f"Error with remote Surge processing: {e}")
+    print("Falling back to local tones.py method")
+    return False
+
+def synthesize_audio(config: MathWaveSonificationConfig, y):
+    """Create audio samples using the method specified in the config, falling back to tones."""
+    # surge-remote only gets here when the remote render failed
+    if config.audioProcessing == 'surge-local':
+        # Try to import Surge only when it's asked for
+        try:
+            return synthesize_surge_local(config, y)
+        except ImportError as error:
+            print(f"Failed to import Surge: {error}")
+        except Exception as e:
+            print(f"Error during surge audio generation: {e}")
         print("Falling back to tones")
-        return await create_tones_audio(config)
+
+    # Default to tones.py
+    return synthesize_tones(y, config.fps)
+
+def render_audio(config: MathWaveSonificationConfig):
+  x, y = evaluate_function(config)
+  samples = synthesize_audio(config, y)
+  write_wav(get_job_file(ensure_job_id(config), AUDIO_FILENAME), samples)
+  return {'status': 'success'}
+
+def render_tones_audio(config: MathWaveSonificationConfig):
+  x, y = evaluate_function(config)
+  write_wav(get_job_file(ensure_job_id(config), AUDIO_FILENAME), synthesize_tones(y, config.fps))
+  return {'status': 'success'}
+
+async def create_tones_audio(config: MathWaveSonificationConfig):
+  ensure_job_id(config)
+  return await run_in_pool(render_tones_audio, config)
+
+async def create_surge_audio_local(config):
+    ensure_job_id(config)
+    config.audioProcessing = 'surge-local'
+    return await run_in_pool(render_audio, config)
 
 # step 3b. create surge audio - remote version
-async def create_surge_audio_remote(config):
-    try:
-        # Prepare the data
-        X, function = await parse_function(config=config)
-        data = {
-            "function": config.function,
-            "x_range_start": config.x_range_start,
-            "x_range_end": config.x_range_end,
-            "num_data_points": config.num_data_points,
-            "fps": config.fps
-        }
-        
-        # Send request to remote server
-        response = requests.post(f"{SURGE_PI_URL}/math_audio", json=data, timeout=30)
-        
-        if response.status_code != 200:
-            print(f"Error from remote Surge server: {response.text}")
-            print("Falling back to local tones.py method")
-            return await create_tones_audio(config)
-        
-        # Save the received WAV file
-        output_dir = 'public/animations'
-        os.makedirs(output_dir, exist_ok=True)
-        
-        with open(os.path.join(output_dir, 'tones.wav'), 'wb') as f:
-            f.write(response.content)
-        
+async def create_surge_audio_remote(config, remote_url=None):
+    ensure_job_id(config)
+    config.audioProcessing = 'surge-remote'
+    if await fetch_surge_audio_remote(config, remote_url):
         return {'status': 'success'}
-    except Exception as e:
-        print(f"Error with remote Surge processing: {e}")
-        print("Falling back to local tones.py method")
-        return await create_tones_audio(config)
+    return await run_in_pool(render_tones_audio, config)
         
 async def create_surge_audio(config: MathWaveSonificationConfig):
     # Default to tones unless specifically configured otherwise
@@ -331,7 +241,7 @@ async def create_surge_audio(config: MathWaveSonificationConfig):
         if config.audioProcessing == 'surge-local':
             return await create_surge_audio_local(config)
         elif config.audioProcessing == 'surge-remote':
-            remote_url = config.remoteUrl if hasattr(config, 'remoteUrl') else 'http://localhost:8888'
+            remote_url = config.remoteURL if config.remoteURL else SURGE_REMOTE_URL
             return await create_surge_audio_remote(config, remote_url)
     
     # Default to standard audio
@@ -342,76 +252,92 @@ async def create_audio(config):
         if config.audioProcessing == 'surge-local':
             return await create_surge_audio_local(config)
         elif config.audioProcessing == 'surge-remote':
-            remote_url = config.remoteUrl if hasattr(config, 'remoteUrl') and config.remoteUrl else 'http://localhost:8888'
+            remote_url = config.remoteURL if config.remoteURL else SURGE_REMOTE_URL
             return await create_surge_audio_remote(config, remote_url)
     
     # Default to tones.py
     return await create_tones_audio(config)
 # step 4. combine video and audio
-async def combine_video_audio(config: MathWaveSonificationConfig):
+def render_combined_video(config: MathWaveSonificationConfig):
   # combine audio and video
-  output_dir = 'public/animations'
-  video = VideoFileClip(output_dir + '/animation.mp4')
-  audio = AudioFileClip(output_dir + '/tones.wav')
-  combined = video.set_audio(audio)
-  
-  combined.write_videofile(f'{output_dir}/{config.function}.mp4', 
-                           codec='libx264',
-                           audio_codec='aac',
-                           temp_audiofile='temp-audio.m4a',
-                           remove_temp=True
-                           )
-  # cleanup
-  combined.close()
-  video.close()
-  audio.close()
+  job_id = ensure_job_id(config)
+  output_format = config.output_format or 'mp4'
+  combine_files(get_job_file(job_id, ANIMATION_FILENAME), get_job_file(job_id, AUDIO_FILENAME),
+                get_job_file(job_id, output_filename(output_format)), output_format)
   return {'status': 'success'}
 
+async def combine_video_audio(config: MathWaveSonificationConfig):
+  ensure_job_id(config)
+  return await run_in_pool(render_combined_video, config)
+
 # step 5. delete intermediate video, audio, and final video
 # assumes video was uploaded successfully
 # NEED NICK TO UPDATE TONES.WAV WITH WHATEVER FILE SURGE PRODUCES
 async def delete_intermediate_files(config: MathWaveSonificationConfig):
-  animation_file = Path(f'public/animations/animation.mp4')
-  audio_file = Path(f'public/animations/tones.wav')
-  final_video_file = Path(f'public/animations/{config.function}.mp4')
+  # everything for a job lives in its own directory
+  if config.job_id:
+    delete_job_dir(config.job_id)
+  else:
+    print('no job id. nothing to delete')
 
-  # put in list to iterate
-  to_delete = [animation_file, audio_file, final_video_file]
+# all steps at once
+def render_cache_key(config: MathWaveSonificationConfig):
+  return sonification_cache_key(config, function=normalize_function(config.function))
 
-  # iterate
-  for file_path in to_delete:
-    try:
-      # check if exists first
-      if file_path.exists():
-        # delete the file
-        file_path.unlink()
-        print(f'deleted: {file_path}')
-      
-      else:
-        print(f'file not found. skipping {file_path}')
-    except Exception as e:
-      print(f'error deleting {file_path}: {e}')
+# evaluates the function a single time and hands the same arrays to the
+# audio and animation stages. audio is synthesized first so frames and audio
+# go through a single ffmpeg encode
+def render_math_sonification(config: MathWaveSonificationConfig, cache_key: str = None, audio_ready: bool = False):
+  job_id = ensure_job_id(config)
+  x, y = evaluate_function(config)
+
+  audio_path = get_job_file(job_id, AUDIO_FILENAME)
+  video_path = get_job_file(job_id, VIDEO_FILENAME)
+  # audio_ready means the remote server already wrote the wav
+  if not audio_ready:
+    write_wav(audio_path, synthesize_audio(config, y))
+  save_animation(config, x, y, video_path, audio_path=audio_path)
+
+  if cache_key:
+    render_cache.store(cache_key, video_path)
+
+  # the wav was only needed as ffmpeg input
+  os.remove(audio_path)
+  return {'status': 'Animation successful'}
+
+# audio only, see render_audio_only
+def render_math_audio(config: MathWaveSonificationConfig, cache_key: str = None, audio_ready: bool = False):
+  return render_audio_only(config, lambda: synthesize_audio(config, evaluate_function(config)[1]), cache_key, audio_ready)
 
 async def math_wave_sonify(config):
+    job_id = ensure_job_id(config)
+
     # parse function and return if invalid
     try:
         X, function = await parse_function(config=config)
     except sp.SympifyError:
         return {"status": sp.SympifyError}
-    
-    # Create animation
-    animation_result = await create_animation(config)
-    if animation_result['status'] != 'success':
-        return {"status": "Animation failed"}
-    
-    # Create audio with selected method
-    audio_result = await create_audio(config)
-    if audio_result['status'] != 'success':
-        return {"status": "Audio generation failed"}
-    
-    # Combine animation and audio
-    combine_result = await combine_video_audio(config)
-    if combine_result['status'] != 'success':
-        return {"status": "Video combination failed"}
-    
-    return {"status": "Animation successful"}
+    output_format = config.output_format or 'mp4'
+    output_filename(output_format) # raises for unknown formats
+
+    if config.audio_only:
+        render, filename, done = render_math_audio, audio_output_filename(config.audio_format), "Audio successful"
+    else:
+        render, filename, done = render_math_sonification, VIDEO_FILENAME, "Animation successful"
+
+    # identical config rendered before, hand out the cached file
+    cache_key = render_cache_key(config)
+    if not (cache_key and render_cache.fetch(cache_key, get_job_file(job_id, filename), suffix=os.path.splitext(filename)[1])):
+        # remote audio is downloaded here, so no render worker waits on the network
+        audio_ready = False
+        if config.audioProcessing == 'surge-remote':
+            audio_ready = await fetch_surge_audio_remote(config)
+
+        # render everything in one pass inside the render pool
+        await run_in_pool(render, config, cache_key, audio_ready)
+
+    # hls and dash are cut from the finished mp4, which is also what the cache keeps
+    if not config.audio_only and output_format != 'mp4':
+        await run_in_pool(segment_video, get_job_file(job_id, VIDEO_FILENAME),
+                          get_job_file(job_id, output_filename(output_format)), output_format)
+    return {"status": done}
@@ -0,0 +1,289 @@
+# combining rendered animations with audio
+# the video track is only ever encoded once: either the audio goes into the
+# same ffmpeg process that receives the animation frames, or the finished
+# animation's h264 track is stream copied and only the audio gets encoded.
+# mp4s are written to <name>.part and renamed once ffmpeg is done, so a file
+# under its real name is always complete. in the fragmented layout the .part
+# is playable from the first fragment on, which lets the api stream a video
+# while it is still being encoded
+import os
+import subprocess
+import wave
+import matplotlib as mpl
+import matplotlib.animation as animation
+import numpy as np
+from api.audio import SAMPLE_RATE, write_wav
+from api.progress import JobCancelled, ProgressWriter
+from api.render_cache import render_cache
+from api.utils import AUDIO_FILENAME, ensure_job_id, get_job_file, audio_output_filename
+
+# fragmented: moov up front and a fragment every FRAGMENT_DURATION, playable while written
+# faststart: one moov moved to the front once encoding finishes, nothing to play until then
+MP4_LAYOUT = os.environ.get('SONIFY_MP4_LAYOUT', 'fragmented')
+FRAGMENT_DURATION = 1000000 # microseconds
+PARTIAL_SUFFIX = '.part'
+# a keyframe this often, so players (and hls/dash segments) can cut and seek anywhere
+KEYFRAME_SECONDS = 2
+# length of hls / dash segments
+STREAM_SEGMENT_SECONDS = int(os.environ.get('SONIFY_STREAM_SEGMENT_SECONDS', 4))
+
+# audio only output: encoder and container for each format (wav is written in process)
+AUDIO_CODECS = {
+  'opus': ['-c:a', 'libopus', '-b:a', '96k', '-f', 'ogg'],
+  'mp3': ['-c:a', 'libmp3lame', '-q:a', '2', '-f', 'mp3'],
+  'flac': ['-c:a', 'flac', '-f', 'flac'],
+}
+AUDIO_CHUNK_SAMPLES = SAMPLE_RATE # samples per write to ffmpeg
+
+def get_ffmpeg_path() -> str:
+  # same binary matplotlib uses for the animation writer
+  return mpl.rcParams['animation.ffmpeg_path']
+
+def run_ffmpeg(args, progress: ProgressWriter = None, duration: float = None):
+  # with progress, ffmpeg's own progress reports become mux_percent of duration
+  command = [get_ffmpeg_path(), '-y', '-loglevel', 'error'] + args
+  if progress is None:
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+      raise RuntimeError(f'ffmpeg failed: {result.stderr.decode(errors="replace").strip()}')
+    return
+
+  command[1:1] = ['-progress', 'pipe:1', '-nostats']
+  proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  try:
+    for line in proc.stdout:
+      key, _, value = line.decode(errors='replace').strip().partition('=')
+      if key == 'out_time_us' and duration and value.isdigit():
+        progress.update(mux_percent=min(100.0, round(int(value) / 1e6 / duration * 100, 1)))
+  except JobCancelled:
+    proc.kill()
+    proc.wait()
+    raise
+  stderr = proc.stderr.read()
+  if proc.wait() != 0:
+    raise RuntimeError(f'ffmpeg failed: {stderr.decode(errors="replace").strip()}')
+  progress.update(force=True, mux_percent=100.0)
+
+def partial_path(file_path: str) -> str:
+  return f'{file_path}{PARTIAL_SUFFIX}'
+
+def h264_args(fps: int):
+  # fragments carry no edit list, so b-frame reordering would start the
+  # video a couple of frames after the audio. applies to intermediate files
+  # too, since their h264 track is stream copied into the final one
+  args = ['-g', str(fps * KEYFRAME_SECONDS)]
+  return args + ['-bf', '0'] if MP4_LAYOUT == 'fragmented' else args
+
+def mp4_output_args(file_path: str):
+  # output options for an mp4 that ends up at file_path, see finish_output
+  if MP4_LAYOUT == 'faststart':
+    layout = ['-movflags', '+faststart']
+  elif MP4_LAYOUT == 'fragmented':
+    layout = ['-movflags', '+empty_moov+default_base_moof', '-frag_duration', str(FRAGMENT_DURATION)]
+  else:
+    raise ValueError(f'unknown mp4 layout: {MP4_LAYOUT}')
+  # the .part extension doesn't tell ffmpeg the format
+  return layout + ['-f', 'mp4', partial_path(file_path)]
+
+def finish_output(file_path: str):
+  os.replace(partial_path(file_path), file_path)
+
+def discard_output(file_path: str):
+  if os.path.exists(partial_path(file_path)):
+    os.remove(partial_path(file_path))
+
+def run_ffmpeg_to(file_path: str, args, progress: ProgressWriter = None, duration: float = None):
+  # run_ffmpeg with args writing the mp4 file_path
+  try:
+    run_ffmpeg(args + mp4_output_args(file_path), progress, duration)
+    finish_output(file_path)
+  finally:
+    discard_output(file_path)
+
+def stream_output_args(playlist_path: str, output_format: str):
+  # segments are written next to the playlist, which is rewritten after
+  # every segment so players can start before the last one exists. segments
+  # are cut at keyframes, so they run KEYFRAME_SECONDS apart at the least
+  directory = os.path.dirname(playlist_path)
+  if output_format == 'hls':
+    return [
+      '-f', 'hls',
+      '-hls_time', str(STREAM_SEGMENT_SECONDS),
+      '-hls_playlist_type', 'event', # becomes a complete vod playlist with its ENDLIST
+      '-hls_segment_type', 'fmp4',
+      '-hls_fmp4_init_filename', 'init.mp4',
+      '-hls_segment_filename', os.path.join(directory, 'segment_%05d.m4s'),
+      '-hls_flags', 'independent_segments+temp_file', # a segment only gets its name once it's complete
+      playlist_path,
+    ]
+  if output_format == 'dash':
+    return [
+      '-f', 'dash',
+      '-seg_duration', str(STREAM_SEGMENT_SECONDS),
+      '-use_template', '1', '-use_timeline', '1',
+      '-init_seg_name', 'init_$RepresentationID$.m4s',
+      '-media_seg_name', 'chunk_$RepresentationID$_$Number%05d$.m4s',
+      playlist_path,
+    ]
+  raise ValueError(f'unknown output format: {output_format}')
+
+def audio_output_args(file_path: str, audio_format: str):
+  if audio_format not in AUDIO_CODECS:
+    raise ValueError(f'unknown audio format: {audio_format}')
+  return AUDIO_CODECS[audio_format] + [partial_path(file_path)]
+
+def encode_audio(samples, file_path: str, audio_format: str, sample_rate: int = SAMPLE_RATE):
+  """
+  Write 16-bit mono samples to file_path as audio_format. The samples are
+  piped straight into one ffmpeg process, no wav in between.
+  """
+  samples = np.asarray(samples, dtype=np.int16)
+  progress = ProgressWriter(file_path, audio_samples=0, total_audio_samples=len(samples))
+  if audio_format == 'wav':
+    with open(partial_path(file_path), 'wb') as f:
+      write_wav(f, samples, sample_rate)
+    finish_output(file_path)
+    progress.update(force=True, audio_samples=len(samples))
+    return
+
+  command = [get_ffmpeg_path(), '-y', '-loglevel', 'error',
+             '-f', 's16le', '-ar', str(sample_rate), '-ac', '1', '-i', 'pipe:'] + audio_output_args(file_path, audio_format)
+  proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+  try:
+    for start in range(0, len(samples), AUDIO_CHUNK_SAMPLES):
+      chunk = samples[start:start + AUDIO_CHUNK_SAMPLES]
+      proc.stdin.write(chunk.tobytes())
+      # raises JobCancelled once the job is cancelled
+      progress.update(audio_samples=start + len(chunk))
+    proc.stdin.close()
+  except BaseException:
+    proc.kill()
+    proc.wait()
+    discard_output(file_path)
+    raise
+  stderr = proc.stderr.read()
+  if proc.wait() != 0:
+    discard_output(file_path)
+    raise RuntimeError(f'ffmpeg failed: {stderr.decode(errors="replace").strip()}')
+  finish_output(file_path)
+  progress.update(force=True, audio_samples=len(samples))
+
+def transcode_audio(wav_path: str, file_path: str, audio_format: str):
+  # for audio that arrived as a wav, e.g. from the remote surge server.
+  # the wav is used up
+  if audio_format == 'wav':
+    os.replace(wav_path, file_path)
+    return
+  try:
+    run_ffmpeg(['-i', wav_path] + audio_output_args(file_path, audio_format),
+               progress=ProgressWriter(file_path, mux_percent=0.0), duration=wav_duration(wav_path))
+    finish_output(file_path)
+  finally:
+    discard_output(file_path)
+  os.remove(wav_path)
+
+def render_audio_only(config, synthesize, cache_key: str = None, audio_ready: bool = False):
+  # audio only /math and /stocks renders: the same audio the video would get,
+  # encoded straight from memory (synthesize() returns the samples) without
+  # an animation or a mux. audio_ready means the remote server wrote the wav
+  job_id = ensure_job_id(config)
+  output_path = get_job_file(job_id, audio_output_filename(config.audio_format))
+
+  if audio_ready:
+    transcode_audio(get_job_file(job_id, AUDIO_FILENAME), output_path, config.audio_format)
+  else:
+    encode_audio(synthesize(), output_path, config.audio_format)
+
+  if cache_key:
+    render_cache.store(cache_key, output_path, suffix=f'.{config.audio_format}')
+  return {'status': 'Audio successful'}
+
+def wav_duration(path: str) -> float:
+  with wave.open(path, 'rb') as wavefile:
+    return wavefile.getnframes() / wavefile.getframerate()
+
+def get_writer(fps: int):
+  Writer = animation.writers['ffmpeg']
+  return Writer(fps=fps, metadata=dict(artist='Me'), bitrate=1800, extra_args=h264_args(fps))
+
+def combine_files(animation_path: str, audio_path: str, output_path: str, output_format: str = 'mp4'):
+  # used by the step by step endpoints, where the animation already exists.
+  # copy its h264 track as is and only encode the audio. output_path is the
+  # playlist for hls and dash
+  args = [
+    '-i', animation_path,
+    '-i', audio_path,
+    '-map', '0:v:0', '-map', '1:a:0',
+    '-c:v', 'copy',
+    '-c:a', 'aac',
+  ]
+  progress = ProgressWriter(output_path, mux_percent=0.0)
+  if output_format == 'mp4':
+    run_ffmpeg_to(output_path, args, progress=progress, duration=wav_duration(audio_path))
+  else:
+    run_ffmpeg(args + stream_output_args(output_path, output_format), progress=progress, duration=wav_duration(audio_path))
+
+def segment_video(video_path: str, output_path: str, output_format: str):
+  # hls / dash from a finished mp4 (the one shot renders), both tracks
+  # copied as they are. output_path is the playlist. the mp4 is used up
+  run_ffmpeg(['-i', video_path, '-c', 'copy'] + stream_output_args(output_path, output_format),
+             progress=ProgressWriter(output_path, mux_percent=0.0))
+  os.remove(video_path)
+
+def concat_files(segment_paths, output_path: str):
+  # joins segments encoded with the same settings, without encoding again
+  list_path = f'{output_path}.txt'
+  with open(list_path, 'w') as f:
+    for path in segment_paths:
+      f.write(f"file '{os.path.abspath(path)}'\n")
+  try:
+    run_ffmpeg_to(output_path, ['-f', 'concat', '-safe', '0', '-i', list_path, '-c', 'copy'])
+  finally:
+    os.remove(list_path)
+
+class FrameEncoder:
+  # ffmpeg process that takes raw frames on stdin, for renderers that draw
+  # frames themselves instead of going through FuncAnimation
+  def __init__(self, file_path: str, width: int, height: int, fps: int, audio_path: str = None, pix_fmt: str = 'rgba',
+               preset: str = None, total_frames: int = 0):
+    args = [get_ffmpeg_path(), '-y', '-loglevel', 'error',
+            '-f', 'rawvideo', '-vcodec', 'rawvideo',
+            '-s', f'{width}x{height}', '-pix_fmt', pix_fmt,
+            '-framerate', str(fps), '-i', 'pipe:']
+    if audio_path:
+      args += ['-i', audio_path, '-map', '0:v:0', '-map', '1:a:0', '-c:a', 'aac']
+    # same settings as the matplotlib writer
+    args += ['-vcodec', 'h264', '-pix_fmt', 'yuv420p', '-b:v', '1800k', '-metadata', 'artist=Me'] + h264_args(fps)
+    if preset:
+      args += ['-preset', preset]
+    args += mp4_output_args(file_path)
+    self.file_path = file_path
+    self._proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    self._frames = 0
+    self._progress = ProgressWriter(file_path, frames=0, total_frames=total_frames)
+
+  def write(self, frame):
+    self._proc.stdin.write(frame)
+    self._frames += 1
+    # raises JobCancelled once the job is cancelled, which kills ffmpeg on the way out
+    self._progress.update(frames=self._frames)
+
+  def close(self):
+    self._proc.stdin.close()
+    stderr = self._proc.stderr.read()
+    if self._proc.wait() != 0:
+      discard_output(self.file_path)
+      raise RuntimeError(f'ffmpeg failed: {stderr.decode(errors="replace").strip()}')
+    finish_output(self.file_path)
+    self._progress.update(force=True, frames=self._frames)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc, tb):
+    if exc_type is None:
+      self.close()
+    else:
+      self._proc.kill()
+      self._proc.wait()
+      discard_output(self.file_path)
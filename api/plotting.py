@@ -0,0 +1,46 @@
+# line chart animations
+# the axes, grid and labels are drawn once. every frame after that only draws
+# the newest segment of the line on top of the previous frame, so rendering
+# time grows linearly with the number of data points
+import matplotlib.pyplot as plt
+from api.media import FrameEncoder
+
+def setup_line_chart(x, y, title: str, x_label: str, y_label: str, graph_color: str, ylim=None):
+  # draws the static parts of the chart and returns an empty line to animate
+  fig = plt.figure()
+  ax = fig.gca()
+  fig.suptitle(title)
+  ax.set_xlabel(x_label)
+  ax.set_ylabel(y_label)
+  ax.grid()
+
+  # plot everything once so the axes autoscale to the finished chart,
+  # then empty the line and draw the static background
+  line, = ax.plot(x, y, color=graph_color, solid_capstyle='round', solid_joinstyle='round')
+  if ylim is not None:
+    ax.set_ylim(ylim)
+  line.set_data([], [])
+  line.set_animated(True)
+  fig.canvas.draw()
+  return fig, ax, line
+
+def save_line_animation(x, y, file_path: str, title: str, x_label: str, y_label: str, graph_color: str,
+                        fps: int, ylim=None, audio_path: str = None, start: int = 0, end: int = None):
+  # start and end pick a run of frames, for rendering a video in segments
+  fig, ax, line = setup_line_chart(x, y, title, x_label, y_label, graph_color, ylim=ylim)
+
+  width, height = fig.canvas.get_width_height()
+  try:
+    if start > 0:
+      # the line as the frame before this segment left it
+      line.set_data(x[:start], y[:start])
+      ax.draw_artist(line)
+    frames = range(start, len(y) if end is None else end)
+    with FrameEncoder(file_path, width, height, fps, audio_path=audio_path, total_frames=len(frames)) as encoder:
+      for n in frames:
+        # one persistent line holding just the segment that's new this frame
+        line.set_data(x[max(n - 1, 0):n + 1], y[max(n - 1, 0):n + 1])
+        ax.draw_artist(line)
+        encoder.write(fig.canvas.buffer_rgba())
+  finally:
+    plt.close(fig)
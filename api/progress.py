@@ -0,0 +1,75 @@
+# render progress and cancellation
+# renders happen in worker processes, so progress is shared through small
+# json files in the job directory. whatever writes an output file (the frame
+# encoders, the wav writer, the muxer) keeps .progress.<file>.json next to it
+# up to date and the server adds them all up. cancelling a job drops a
+# .cancel marker in the directory, which the same writers check so they can
+# kill their ffmpeg and stop
+import json
+import os
+import time
+
+PROGRESS_INTERVAL = 0.25 # seconds between writes (and cancel checks)
+CANCEL_FILENAME = '.cancel'
+
+
+class JobCancelled(Exception):
+  pass
+
+
+def progress_path(file_path: str) -> str:
+  directory, name = os.path.split(file_path)
+  return os.path.join(directory, f'.progress.{name}.json')
+
+class ProgressWriter:
+  def __init__(self, file_path: str, **counts):
+    self.path = progress_path(file_path)
+    self.cancel_path = os.path.join(os.path.dirname(file_path), CANCEL_FILENAME)
+    self.counts = counts
+    self._written = 0.0
+
+  def update(self, force: bool = False, **counts):
+    """Record counts, writing them out (and checking for cancellation) at most every PROGRESS_INTERVAL."""
+    self.counts.update(counts)
+    now = time.monotonic()
+    if not force and now - self._written < PROGRESS_INTERVAL:
+      return
+    self._written = now
+
+    temp_path = f'{self.path}.tmp'
+    with open(temp_path, 'w') as f:
+      json.dump(self.counts, f)
+    os.replace(temp_path, self.path)
+    if os.path.exists(self.cancel_path):
+      raise JobCancelled('job was cancelled')
+
+def read_progress(directory: str) -> dict:
+  # counts from every writer added up (segments of one video add up to the
+  # whole), percentages are the furthest along
+  progress = {}
+  try:
+    names = [name for name in os.listdir(directory) if name.startswith('.progress.') and name.endswith('.json')]
+  except FileNotFoundError:
+    return progress
+  for name in names:
+    try:
+      with open(os.path.join(directory, name)) as f:
+        counts = json.load(f)
+    except (OSError, ValueError):
+      continue
+    for key, value in counts.items():
+      if key.endswith('_percent'):
+        progress[key] = max(progress.get(key, 0), value)
+      else:
+        progress[key] = progress.get(key, 0) + value
+  return progress
+
+def request_cancel(directory: str):
+  if os.path.isdir(directory):
+    open(os.path.join(directory, CANCEL_FILENAME), 'w').close()
+
+def clear_cancel(directory: str):
+  try:
+    os.remove(os.path.join(directory, CANCEL_FILENAME))
+  except FileNotFoundError:
+    pass
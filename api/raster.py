@@ -0,0 +1,77 @@
+# fast line chart animations
+# matplotlib draws the static chart once. after that the line is rasterized
+# straight into a numpy framebuffer: every segment's pixels are computed up
+# front in a few vectorized steps, and each frame only paints the pixels of
+# its new segment before the raw frame goes to ffmpeg
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.colors import to_rgb
+from api.media import FrameEncoder
+from api.plotting import setup_line_chart
+
+# pixel offsets stamped around every point on the line (about matplotlib's
+# default 1.5pt line width at 100 dpi)
+BRUSH = np.array([(0, 0), (-1, 0), (1, 0), (0, -1), (0, 1)])
+
+def rasterize_segments(points, clip_box):
+  """
+  Rasterize the polyline through points (pixel coordinates, origin top left).
+
+  Returns rows, cols and the index of the segment each pixel belongs to,
+  sorted by segment and clipped to clip_box (row0, row1, col0, col1).
+  """
+  starts = points[:-1]
+  ends = points[1:]
+  # segments touching nan/inf (e.g. tan(x) asymptotes) are skipped
+  valid = np.isfinite(starts).all(axis=1) & np.isfinite(ends).all(axis=1)
+  segment_ids = np.nonzero(valid)[0]
+  starts = starts[valid]
+  ends = ends[valid]
+
+  # one sample per pixel of length along each segment
+  lengths = np.hypot(*(ends - starts).T)
+  steps = np.ceil(lengths).astype(int) + 1
+  offsets = np.cumsum(steps) - steps
+  owner = np.repeat(np.arange(len(steps)), steps)
+  t = (np.arange(steps.sum()) - offsets[owner]) / np.maximum(steps - 1, 1)[owner]
+  samples = starts[owner] + t[:, None] * (ends[owner] - starts[owner])
+
+  # stamp the brush around every sample
+  rows = (np.rint(samples[:, 1])[:, None] + BRUSH[:, 1]).astype(int).ravel()
+  cols = (np.rint(samples[:, 0])[:, None] + BRUSH[:, 0]).astype(int).ravel()
+  segments = np.repeat(segment_ids[owner], len(BRUSH))
+
+  row0, row1, col0, col1 = clip_box
+  inside = (rows >= row0) & (rows < row1) & (cols >= col0) & (cols < col1)
+  return rows[inside], cols[inside], segments[inside]
+
+def save_raster_line_animation(x, y, file_path: str, title: str, x_label: str, y_label: str, graph_color: str,
+                               fps: int, ylim=None, audio_path: str = None, start: int = 0, end: int = None):
+  # start and end pick a run of frames, for rendering a video in segments
+  fig, ax, line = setup_line_chart(x, y, title, x_label, y_label, graph_color, ylim=ylim)
+  width, height = fig.canvas.get_width_height()
+  frame = np.ascontiguousarray(np.asarray(fig.canvas.buffer_rgba())[:, :, :3])
+
+  # data to pixel coordinates (matplotlib's origin is bottom left)
+  points = ax.transData.transform(np.column_stack([x, y]).astype(float))
+  points[:, 1] = height - points[:, 1]
+  x0, y0, x1, y1 = ax.bbox.extents
+  clip_box = (int(np.ceil(height - y1)), int(np.floor(height - y0)) + 1, int(np.ceil(x0)), int(np.floor(x1)) + 1)
+  plt.close(fig)
+
+  rows, cols, segments = rasterize_segments(points, clip_box)
+  # frame n shows the line up to point n, i.e. segments 0 .. n - 1
+  bounds = np.searchsorted(segments, np.arange(len(y)), side='left')
+  color = (np.array(to_rgb(graph_color)) * 255).astype(np.uint8)
+
+  # drawing is cheap now, so don't let x264's default preset become the bottleneck
+  frames = range(start, len(y) if end is None else end)
+  with FrameEncoder(file_path, width, height, fps, audio_path=audio_path, pix_fmt='rgb24', preset='veryfast',
+                    total_frames=len(frames)) as encoder:
+    # the line as the frame before this segment left it
+    painted = bounds[start - 1] if start > 0 else 0
+    frame[rows[:painted], cols[:painted]] = color
+    for n in frames:
+      frame[rows[painted:bounds[n]], cols[painted:bounds[n]]] = color
+      painted = bounds[n]
+      encoder.write(frame.data)
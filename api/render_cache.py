@@ -0,0 +1,120 @@
+# finished render cache
+# identical configs (the default x*sin(x), SPY on the same day, the same
+# uploaded image) produce identical videos, so finished files are kept on
+# local disk under a hash of everything that went into them. the least
+# recently used files are evicted once the cache goes over its size budget
+import hashlib
+import json
+import os
+import shutil
+import uuid
+
+RENDER_CACHE_DIR = os.environ.get('SONIFY_RENDER_CACHE_DIR', 'render_cache')
+RENDER_CACHE_MAX_BYTES = int(os.environ.get('SONIFY_RENDER_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+
+
+def config_cache_key(config, exclude=('job_id',), **overrides) -> str:
+  # exclude fields that don't change the output, override fields that need
+  # normalizing, e.g. the function string
+  fields = config.model_dump(exclude=set(exclude))
+  fields.update(overrides)
+  payload = json.dumps({'type': type(config).__name__, 'fields': fields}, sort_keys=True, default=str)
+  return hashlib.sha256(payload.encode()).hexdigest()
+
+# fields that only change the picture, not the audio (same names in the math and stocks configs)
+PLOT_FIELDS = ('x_label', 'y_label', 'title', 'graph_color', 'animation_engine')
+
+def cache_key_exclude(config, plot_fields=PLOT_FIELDS):
+  # only the fields that change the file handed out go in the key: videos
+  # don't depend on the audio only format, audio doesn't depend on the plot
+  exclude = ('job_id', 'surgePath', 'remoteURL', 'output_format')
+  if config.audio_only:
+    return exclude + tuple(plot_fields)
+  return exclude + ('audio_only', 'audio_format')
+
+def sonification_cache_key(config, plot_fields=PLOT_FIELDS, **overrides) -> str:
+  # key of a one shot math or stocks render, or None if it can't be cached.
+  # surge output depends on the local install or the remote server, so only
+  # tones renders are cached
+  if config.audioProcessing not in ('', 'tones'):
+    return None
+  return config_cache_key(config, exclude=cache_key_exclude(config, plot_fields), **overrides)
+
+def new_cache_digest(kind: str):
+  # for inputs that arrive in chunks, update() it with each one and use hexdigest() as the key
+  return hashlib.sha256(kind.encode())
+
+def _link_or_copy(source: str, destination: str):
+  # hard links are free and deleting the job directory leaves the cache alone.
+  # the file goes in under a temporary name next to destination and is then
+  # renamed over it, so an existing file there (a job id sent again after a
+  # cache hit) is replaced instead of failing, and readers never see a partial file
+  temp_path = f'{destination}.{uuid.uuid4().hex}.tmp'
+  try:
+    os.link(source, temp_path)
+  except OSError:
+    shutil.copyfile(source, temp_path)
+  os.replace(temp_path, destination)
+  # renaming over another link to the same file is a no op that leaves the temporary name
+  try:
+    os.remove(temp_path)
+  except FileNotFoundError:
+    pass
+
+
+class RenderCache:
+  def __init__(self, cache_dir: str = RENDER_CACHE_DIR, max_bytes: int = RENDER_CACHE_MAX_BYTES):
+    self.cache_dir = cache_dir
+    self.max_bytes = max_bytes
+    self.hits = 0
+    self.misses = 0
+
+  def path(self, key: str, suffix: str = '.mp4') -> str:
+    return os.path.join(self.cache_dir, key + suffix)
+
+  def fetch(self, key: str, destination: str, suffix: str = '.mp4') -> bool:
+    """Put the cached file for key at destination. Returns False on a miss."""
+    path = self.path(key, suffix)
+    try:
+      _link_or_copy(path, destination)
+    except FileNotFoundError:
+      self.misses += 1
+      return False
+
+    # mtime is what eviction sorts on. the file is already in place, so
+    # another worker evicting the entry meanwhile doesn't matter
+    try:
+      os.utime(path)
+    except FileNotFoundError:
+      pass
+    self.hits += 1
+    return True
+
+  def store(self, key: str, source: str, suffix: str = '.mp4'):
+    os.makedirs(self.cache_dir, exist_ok=True)
+    _link_or_copy(source, self.path(key, suffix))
+    self.evict()
+
+  def evict(self):
+    try:
+      entries = [entry for entry in os.scandir(self.cache_dir) if entry.is_file() and not entry.name.endswith('.tmp')]
+    except FileNotFoundError:
+      return
+
+    # oldest first
+    files = sorted(((entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in entries))
+    total = sum(size for _, size, _ in files)
+    for _, size, path in files:
+      if total <= self.max_bytes:
+        break
+      try:
+        os.remove(path)
+      except FileNotFoundError:
+        pass
+      total -= size
+
+  def stats(self):
+    return {'dir': self.cache_dir, 'max_bytes': self.max_bytes, 'hits': self.hits, 'misses': self.misses}
+
+
+render_cache = RenderCache()
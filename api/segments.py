@@ -0,0 +1,53 @@
+# segmented rendering
+# a long animation is split into runs of frames that are rendered and
+# encoded at the same time by different render workers, then joined with
+# ffmpeg's concat demuxer (no second encode). wall clock time then scales
+# with the number of workers instead of one ffmpeg pipe
+import asyncio
+import os
+import numpy as np
+from api.executor import RENDER_WORKERS, run_in_pool
+from api.media import concat_files
+
+# shorter segments aren't worth the extra figure setup and process hop
+SEGMENT_MIN_FRAMES = int(os.environ.get('SONIFY_SEGMENT_MIN_FRAMES', 300))
+
+
+def plan_segments(num_frames: int, workers: int = RENDER_WORKERS, min_frames: int = SEGMENT_MIN_FRAMES):
+  # (start, end) frame ranges, at most one per worker
+  count = max(1, min(workers, num_frames // max(min_frames, 1)))
+  edges = np.linspace(0, num_frames, count + 1).astype(int)
+  return list(zip(edges[:-1].tolist(), edges[1:].tolist()))
+
+def segment_path(file_path: str, index: int) -> str:
+  root, ext = os.path.splitext(file_path)
+  return f'{root}.part{index}{ext}'
+
+async def render_segmented(render_segment, args, num_frames: int, file_path: str):
+  """
+  Render frames 0 .. num_frames - 1 to file_path with
+  render_segment(*args, segment_file_path, start, end), a module level
+  function that encodes frames start .. end - 1.
+  """
+  segments = plan_segments(num_frames)
+  if len(segments) == 1:
+    await run_in_pool(render_segment, *args, file_path, 0, num_frames)
+    return {'status': 'success'}
+
+  paths = [segment_path(file_path, i) for i in range(len(segments))]
+  try:
+    # wait for every segment, even after one fails, so none is still
+    # writing when the parts are cleaned up
+    results = await asyncio.gather(
+      *(run_in_pool(render_segment, *args, path, start, end) for path, (start, end) in zip(paths, segments)),
+      return_exceptions=True,
+    )
+    for result in results:
+      if isinstance(result, BaseException):
+        raise result
+    await run_in_pool(concat_files, paths, file_path)
+  finally:
+    for path in paths:
+      if os.path.exists(path):
+        os.remove(path)
+  return {'status': 'success'}
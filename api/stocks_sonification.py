@@ -1,207 +1,140 @@
 import numpy as np
 import os
-import matplotlib.pyplot as plt
-import matplotlib.animation as animation
-from tones import SINE_WAVE
-from tones.mixer import Mixer
-from moviepy.editor import VideoFileClip, AudioFileClip
-from api.utils import StocksSonificationConfig
-from pathlib import Path
-import yfinance as yf
-import requests
-import wave
+from datetime import date
+from api.audio import SAMPLE_RATE, synthesize_tones, normalize_samples, write_wav
+from api.executor import run_in_pool
+from api.downsample import downsample
+from api.market_data import get_close_prices
+from api.media import combine_files, render_audio_only, segment_video
+from api.plotting import save_line_animation
+from api.render_cache import render_cache, sonification_cache_key
+from api.segments import render_segmented
+from api.surge import import_surgepy, render_pitch_track, surge_pool
+from api.surge_remote import SURGE_REMOTE_URL, fetch_remote_audio
+from api.raster import save_raster_line_animation
+from api.utils import (
+    StocksSonificationConfig, ANIMATION_FILENAME, AUDIO_FILENAME, VIDEO_FILENAME,
+    ensure_job_id, get_job_file, delete_job_dir, output_filename, audio_output_filename
+)
 
 # step 1. validate stock
 async def validate_ticker(config: StocksSonificationConfig):
-  ticker = yf.Ticker(config.ticker)
-  return ticker
+  # downloading the history both checks the ticker and warms the cache for
+  # every step after this one
+  x, y = await run_in_pool(fetch_prices, config)
+  return y
+
+def fetch_prices(config: StocksSonificationConfig):
+  # every stage below works off these arrays, downloaded at most once per TTL
+  period = f'{config.num_days}d' if config.num_days else 'max'
+  y = get_close_prices(config.ticker, period, config.data_source,
+                       config.start_date, config.end_date, config.interval)
+  # gaps would become silent frames, drop them
+  x = np.flatnonzero(np.isfinite(y))
+  y = y[x]
+  # bounds the frame and note count however much history was asked for
+  return downsample(x, y, config.max_frames, config.downsample)
 
 # step 2. create animation
-async def create_stocks_animation(config: StocksSonificationConfig):
-  ticker = yf.Ticker(config.ticker)
-  # ['Open', 'High', 'Low', 'Close', 'Volume', 'Dividends', 'Stock Splits']
-  hist = ticker.history(period='2y')
-  x = np.array([i for i in range(len(hist))])
-  y = np.array([row['Close'] for _, row in hist.iterrows()])
+def save_stocks_animation(config: StocksSonificationConfig, x, y, file_path: str, audio_path: str = None,
+                          start: int = 0, end: int = None):
+  # with audio_path the audio is muxed in by the same ffmpeg process
+  save = save_raster_line_animation if config.animation_engine == 'fast' else save_line_animation
+  save(x, y, file_path, config.title, config.x_label, config.y_label, config.graph_color,
+       config.fps, audio_path=audio_path, start=start, end=end)
 
-  # save animation
-  fig = plt.figure()
-  fig.suptitle(config.title)
-  plt.xlabel(config.x_label)
-  plt.ylabel(config.y_label)
-  plt.grid()
-  
-  def animate(n):
-    line, = plt.plot(x[:n], y[:n], color=config.graph_color)
-    return line,
-  
-  fps = config.fps
-  frames = len(y)
-  interval = 1000 / fps
+# render_* functions do the blocking work and run inside the render pool
+def render_stocks_animation_segment(config: StocksSonificationConfig, x, y, file_path: str, start: int, end: int):
+  save_stocks_animation(config, x, y, file_path, start=start, end=end)
 
-  ani = animation.FuncAnimation(fig=fig, func=animate, frames=frames, interval=interval, blit=True)
-  Writer = animation.writers['ffmpeg']
-  writer = Writer(fps=fps, metadata=dict(artist='Me'), bitrate=1800)
+async def create_stocks_animation(config: StocksSonificationConfig):
+  # long histories are rendered in segments on several workers at once
+  job_id = ensure_job_id(config)
+  x, y = await run_in_pool(fetch_prices, config)
+  return await render_segmented(render_stocks_animation_segment, (config, x, y), len(y),
+                                get_job_file(job_id, ANIMATION_FILENAME))
+
+# step 3. create audio
+# synthesize_* functions turn the price series into 16-bit samples
+STOCKS_PATCH = os.path.join("C:\\Users\\nickl\\Documents\\surge-demo\\surge\\resources\\data\\", "patches_factory\\Polysynths\\Licht.fxp")
+
+def synthesize_stocks_surge_local(config: StocksSonificationConfig, y):
+    # Use the path provided in the request
+    surgepy = import_surgepy(config.surgePath)
+    
+    # Map stock data to pitch bend values, one frame of audio per price
+    with surge_pool.acquire(surgepy, SAMPLE_RATE, STOCKS_PATCH) as instance:
+        audio_data = render_pitch_track(instance.surge, instance.pitch, y, config.fps, instance.sample_rate)
+    
+    # Normalize and format audio data
+    return normalize_samples(audio_data)
+
+# the remote server is called from the event loop (see api/surge_remote.py)
+# before any render work is queued. it writes the job's wav itself
+async def fetch_stocks_surge_audio_remote(config: StocksSonificationConfig, y, remote_url=None):
+    """Download the remote Surge render into the job directory. Returns False if tones should be used instead."""
+    # Prepare the data to send (prices we already have, no second download)
+    data = {
+        "ticker": config.ticker,
+        "prices": [float(price) for price in y],
+        "fps": config.fps
+    }
+    
+    try:
+        await fetch_remote_audio(remote_url or config.remoteURL, "stocks_audio", data,
+                                 get_job_file(ensure_job_id(config), AUDIO_FILENAME))
+        return True
+    except Exception as e:
+        print(f"Error with remote Surge processing: {e}")
+    print("Falling back to local tones.py method")
+    return False
+
+def synthesize_stocks_audio(config: StocksSonificationConfig, y):
+    """Create audio samples using the method specified in the config, falling back to tones."""
+    # surge-remote only gets here when the remote render failed
+    if config.audioProcessing == 'surge-local':
+        # Try to import Surge only when it's asked for
+        try:
+            return synthesize_stocks_surge_local(config, y)
+        except ImportError as error:
+            print(f"Failed to import Surge: {error}")
+        except Exception as e:
+            print(f"Error during surge audio generation: {e}")
+        print("Falling back to tones")
 
-  # make sure directory exists
-  output_dir = 'public/animations'
-  os.makedirs(output_dir, exist_ok=True)
-  file_path = os.path.join(output_dir, 'animation.mp4')
-  ani.save(file_path, writer=writer)
-  plt.close(fig)
+    # Default to tones.py
+    return synthesize_tones(y, config.fps)
+
+def render_stocks_audio(config: StocksSonificationConfig):
+  x, y = fetch_prices(config)
+  samples = synthesize_stocks_audio(config, y)
+  write_wav(get_job_file(ensure_job_id(config), AUDIO_FILENAME), samples)
   return {'status': 'success'}
 
 # step 3a. create audio with tones
-async def create_stocks_tones_audio(config: StocksSonificationConfig):
-  ticker = yf.Ticker(config.ticker)
-  hist = ticker.history(period='2y')
-  x = np.array([i for i in range(len(hist))])
-  y = np.array([row['Close'] for _, row in hist.iterrows()])
-  output_dir = 'public/animations'
-  video_time = len(y) / config.fps
-
-  # generate audio
-  diff = 2
-  notes = ['c', 'c#', 'd', 'd#', 'e', 'f', 'f#', 'g', 'g#', 'a', 'a#', 'b'] * (9 - 2 * diff)
-  # (octaves are 0 - 8 as per tones package)
-  # but skipping lowest 2 since you can't hear them and highest 2 since they sound bad
-
-  num_notes = len(notes)
-  min_value = min(y)
-  max_value = max(y)
-  value_range = np.linspace(min_value, max_value, num_notes)
-  mixer = Mixer(44100, 0.5)
-  mixer.create_track(0, SINE_WAVE, attack=0.01, decay=0.1)
-
-  def clamp(j, diff): # returns inner values (diff inside 9)
-    return max(min(len(notes) // 12, j // 12 + diff), j // 12 - diff)
-
-  for i, value in enumerate(y):
-    for j, v in enumerate(value_range):
-      if value < v:
-        if i < len(y) - 1:
-          if y[i + 1] > y[i] and j < len(value_range) - 1:
-            mixer.add_note(0, note=notes[j], octave=clamp(j, diff), duration=video_time / len(y), endnote=notes[j + 1])
-          else:
-            mixer.add_note(0, note=notes[j], octave=clamp(j, diff), duration=video_time / len(y), endnote=notes[j - 1])
-        break
-  
-  mixer.write_wav(output_dir + '/tones.wav')
+def render_stocks_tones_audio(config: StocksSonificationConfig):
+  x, y = fetch_prices(config)
+  write_wav(get_job_file(ensure_job_id(config), AUDIO_FILENAME), synthesize_tones(y, config.fps))
   return {'status': 'success'}
 
+async def create_stocks_tones_audio(config: StocksSonificationConfig):
+  ensure_job_id(config)
+  return await run_in_pool(render_stocks_tones_audio, config)
+
 # step 3b. create audio with local surge
 async def create_stocks_surge_audio_local(config: StocksSonificationConfig):
-    # Try to import Surge only when this function is called
-    try:
-        import sys
-        # Use the path provided in the request
-        if hasattr(config, 'surgePath') and config.surgePath:
-            surge_path = config.surgePath
-            sys.path.append(surge_path)
-            
-        # Now try to import Surge
-        import surgepy
-        from surgepy import constants as srgco
-        
-        # Get stock data
-        ticker = yf.Ticker(config.ticker)
-        hist = ticker.history(period='2y')
-        x = np.array([i for i in range(len(hist))])
-        y = np.array([row['Close'] for _, row in hist.iterrows()])
-        
-        video_time = len(y) / config.fps
-        sample_rate = 44100
-    
-        surge = surgepy.createSurge(sample_rate)
-        
-        # Configure Surge synthesizer
-        surge.loadPatch(os.path.join("C:\\Users\\nickl\\Documents\\surge-demo\\surge\\resources\\data\\", "patches_factory\\Polysynths\\Licht.fxp"))
-        cg_Global = surge.getControlGroup(srgco.cg_GLOBAL)
-        globalEnts = cg_Global.getEntries()
-        globalPar = globalEnts[1].getParams()
-        pitch = globalPar[1]  # global scene pitch parameter
-        
-        # Normalize stock values to 0-1 range
-        min_value = min(y)
-        max_value = max(y)
-        value_range = max_value - min_value
-        normalized_values = [(v - min_value) / value_range for v in y]
-        
-        # Calculate blocks needed for audio
-        blocks_per_frame = int(sample_rate // config.fps // surge.getBlockSize())
-        total_samples = int(np.ceil(video_time * sample_rate))
-        audio_data = np.zeros((total_samples // surge.getBlockSize(), surge.getBlockSize()))
-        
-        # Generate audio
-        surge.playNote(0, 60, 127, 0)  # Middle C Midi note
-        pos = 0
-        
-        # Map stock data to pitch bend values
-        for i, value in enumerate(normalized_values):
-            pitch_bend_amount = value * 14 - 7  # Scale to range -7 to +7
-            surge.setParamVal(pitch, pitch_bend_amount)
-            
-            for _ in range(blocks_per_frame):
-                surge.process()
-                audio_data[pos, :] = surge.getOutput()[0, :]
-                pos += 1
-                
-        surge.releaseNote(0, 60, 0)
-        
-        # Normalize and format audio data
-        audio_max = np.max(np.abs(audio_data))
-        audio_data /= audio_max
-        audio_data = (audio_data * 32767).astype(np.int16)
-
-        # Save audio file
-        output_filename = 'public/animations/tones.wav'
-        with wave.open(output_filename, 'w') as wavefile:
-            wavefile.setnchannels(1) 
-            wavefile.setsampwidth(2)   
-            wavefile.setframerate(44100)
-            wavefile.writeframes(audio_data.tobytes())
-
-        return {'status': 'success'}
-    except ImportError as error:
-        print(f"Failed to import Surge: {error}")
-        print("Falling back to tones")
-        return await create_stocks_tones_audio(config)
+    ensure_job_id(config)
+    config.audioProcessing = 'surge-local'
+    return await run_in_pool(render_stocks_audio, config)
 
 # step 3c. create audio with remote surge
-async def create_stocks_surge_audio_remote(config: StocksSonificationConfig, remote_url='http://localhost:8888'):
-    try:
-        # Get stock data for remote processing
-        ticker = yf.Ticker(config.ticker)
-        hist = ticker.history(period='2y')
-        close_prices = [float(row['Close']) for _, row in hist.iterrows()]
-        
-        # Prepare the data to send
-        data = {
-            "ticker": config.ticker,
-            "prices": close_prices,
-            "fps": config.fps
-        }
-        
-        # Send request to remote server
-        response = requests.post(f"{remote_url}/stocks_audio", json=data, timeout=30)
-        
-        if response.status_code != 200:
-            print(f"Error from remote Surge server: {response.text}")
-            print("Falling back to local tones.py method")
-            return await create_stocks_tones_audio(config)
-        
-        # Save the received WAV file
-        output_dir = 'public/animations'
-        os.makedirs(output_dir, exist_ok=True)
-        
-        with open(os.path.join(output_dir, 'tones.wav'), 'wb') as f:
-            f.write(response.content)
-        
+async def create_stocks_surge_audio_remote(config: StocksSonificationConfig, remote_url=None):
+    ensure_job_id(config)
+    config.audioProcessing = 'surge-remote'
+    x, y = await run_in_pool(fetch_prices, config)
+    if await fetch_stocks_surge_audio_remote(config, y, remote_url):
         return {'status': 'success'}
-    except Exception as e:
-        print(f"Error with remote Surge processing: {e}")
-        print("Falling back to local tones.py method")
-        return await create_stocks_tones_audio(config)
+    return await run_in_pool(render_stocks_tones_audio, config)
 
 # step 3. create audio - main function that selects the appropriate method
 async def create_stocks_audio(config: StocksSonificationConfig):
@@ -210,51 +143,87 @@ async def create_stocks_audio(config: StocksSonificationConfig):
         if config.audioProcessing == 'surge-local':
             return await create_stocks_surge_audio_local(config)
         elif config.audioProcessing == 'surge-remote':
-            remote_url = config.remoteURL if hasattr(config, 'remoteURL') and config.remoteURL else 'http://localhost:8888'
+            remote_url = config.remoteURL if config.remoteURL else SURGE_REMOTE_URL
             return await create_stocks_surge_audio_remote(config, remote_url)
     
     # Default to tones.py
     return await create_stocks_tones_audio(config)
 
 # step 4. combine video and audio
-async def combine_stocks_video_audio(config: StocksSonificationConfig):
+def render_stocks_combined_video(config: StocksSonificationConfig):
   # combine audio and video
-  output_dir = 'public/animations'
-  video = VideoFileClip(output_dir + '/animation.mp4')
-  audio = AudioFileClip(output_dir + '/tones.wav')
-  combined = video.set_audio(audio)
-  
-  combined.write_videofile(f'{output_dir}/{config.ticker}.mp4', 
-                           codec='libx264',
-                           audio_codec='aac',
-                           temp_audiofile='temp-audio.m4a',
-                           remove_temp=True
-                           )
-  # cleanup
-  combined.close()
-  video.close()
-  audio.close()
+  job_id = ensure_job_id(config)
+  output_format = config.output_format or 'mp4'
+  combine_files(get_job_file(job_id, ANIMATION_FILENAME), get_job_file(job_id, AUDIO_FILENAME),
+                get_job_file(job_id, output_filename(output_format)), output_format)
   return {'status': 'success'}
 
+async def combine_stocks_video_audio(config: StocksSonificationConfig):
+  ensure_job_id(config)
+  return await run_in_pool(render_stocks_combined_video, config)
+
 # step 5. delete intermediate video, audio, and final video
 async def delete_intermediate_stocks_files(config: StocksSonificationConfig):
-  animation_file = Path(f'public/animations/animation.mp4')
-  audio_file = Path(f'public/animations/tones.wav')
-  final_video_file = Path(f'public/animations/{config.ticker}.mp4')
-
-  # put in list to iterate
-  to_delete = [animation_file, audio_file, final_video_file]
-
-  # iterate
-  for file_path in to_delete:
-    try:
-      # check if exists first
-      if file_path.exists():
-        # delete the file
-        file_path.unlink()
-        print(f'deleted: {file_path}')
-      
-      else:
-        print(f'file not found. skipping {file_path}')
-    except Exception as e:
-      print(f'error deleting {file_path}: {e}')
\ No newline at end of file
+  # everything for a job lives in its own directory
+  if config.job_id:
+    delete_job_dir(config.job_id)
+  else:
+    print('no job id. nothing to delete')
+
+# all steps at once
+def render_cache_key(config: StocksSonificationConfig):
+  # prices change every trading day
+  return sonification_cache_key(config, ticker=config.ticker.upper(), day=date.today().isoformat())
+
+# downloads the history a single time and hands the same arrays to the
+# audio and animation stages. audio is synthesized first so frames and audio
+# go through a single ffmpeg encode
+def render_stocks_sonification(config: StocksSonificationConfig, cache_key: str = None, audio_ready: bool = False):
+  job_id = ensure_job_id(config)
+  x, y = fetch_prices(config)
+
+  audio_path = get_job_file(job_id, AUDIO_FILENAME)
+  video_path = get_job_file(job_id, VIDEO_FILENAME)
+  # audio_ready means the remote server already wrote the wav
+  if not audio_ready:
+    write_wav(audio_path, synthesize_stocks_audio(config, y))
+  save_stocks_animation(config, x, y, video_path, audio_path=audio_path)
+
+  if cache_key:
+    render_cache.store(cache_key, video_path)
+
+  # the wav was only needed as ffmpeg input
+  os.remove(audio_path)
+  return {'status': 'Animation successful'}
+
+# audio only, see render_audio_only
+def render_stocks_audio_only(config: StocksSonificationConfig, cache_key: str = None, audio_ready: bool = False):
+  return render_audio_only(config, lambda: synthesize_stocks_audio(config, fetch_prices(config)[1]), cache_key, audio_ready)
+
+async def stocks_sonify(config: StocksSonificationConfig):
+  job_id = ensure_job_id(config)
+  output_format = config.output_format or 'mp4'
+  output_filename(output_format) # raises for unknown formats
+
+  if config.audio_only:
+    render, filename, done = render_stocks_audio_only, audio_output_filename(config.audio_format), 'Audio successful'
+  else:
+    render, filename, done = render_stocks_sonification, VIDEO_FILENAME, 'Animation successful'
+
+  # identical config rendered today, hand out the cached file
+  cache_key = render_cache_key(config)
+  if not (cache_key and render_cache.fetch(cache_key, get_job_file(job_id, filename), suffix=os.path.splitext(filename)[1])):
+    # remote audio is downloaded here, so no render worker waits on the network.
+    # the prices come from the same cache the render reads
+    audio_ready = False
+    if config.audioProcessing == 'surge-remote':
+      x, y = await run_in_pool(fetch_prices, config)
+      audio_ready = await fetch_stocks_surge_audio_remote(config, y)
+
+    await run_in_pool(render, config, cache_key, audio_ready)
+
+  # hls and dash are cut from the finished mp4, which is also what the cache keeps
+  if not config.audio_only and output_format != 'mp4':
+    await run_in_pool(segment_video, get_job_file(job_id, VIDEO_FILENAME),
+                      get_job_file(job_id, output_filename(output_format)), output_format)
+  return {'status': done}
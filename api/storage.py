@@ -0,0 +1,256 @@
+# artifact storage
+# where finished videos go once they are rendered and how clients get them.
+# renders always happen in the local job directory; the storage backend
+# decides what URL the client gets back:
+#   local  the job directory is under public/, which next.js serves as is
+#   s3     the file is uploaded to an s3 compatible bucket (aws, minio, r2...)
+#          and the client gets a presigned GET url for it
+# nothing has to be deleted by hand. jobs and uploads older than
+# SONIFY_ARTIFACT_TTL are collected every SONIFY_GC_INTERVAL seconds
+import asyncio
+import datetime
+import hashlib
+import hmac
+import mimetypes
+import os
+import shutil
+import time
+import xml.etree.ElementTree as ET
+from urllib.parse import quote, urlsplit
+import httpx
+from api.utils import OUTPUT_DIR, OUTPUT_FILENAMES, VIDEO_FILENAME, JOB_ID_PATTERN, get_job_file, get_job_url
+
+STORAGE_BACKEND = os.environ.get('SONIFY_STORAGE', 'local') # local or s3
+ARTIFACT_TTL = int(os.environ.get('SONIFY_ARTIFACT_TTL', 24 * 60 * 60)) # seconds
+GC_INTERVAL = int(os.environ.get('SONIFY_GC_INTERVAL', 10 * 60)) # seconds
+
+S3_ENDPOINT = os.environ.get('SONIFY_S3_ENDPOINT', 'https://s3.amazonaws.com')
+S3_BUCKET = os.environ.get('SONIFY_S3_BUCKET', 'sonify')
+S3_REGION = os.environ.get('SONIFY_S3_REGION', 'us-east-1')
+S3_ACCESS_KEY = os.environ.get('SONIFY_S3_ACCESS_KEY', '')
+S3_SECRET_KEY = os.environ.get('SONIFY_S3_SECRET_KEY', '')
+S3_PREFIX = os.environ.get('SONIFY_S3_PREFIX', 'animations/')
+# files larger than one part go up as a multipart upload, one part at a time.
+# s3 wants parts of at least 5MB (except the last)
+S3_PART_SIZE = int(os.environ.get('SONIFY_S3_PART_SIZE', 8 * 1024 * 1024))
+# presigned urls can't outlive 7 days, and there's no point outliving the object
+S3_URL_EXPIRY = min(int(os.environ.get('SONIFY_S3_URL_EXPIRY', ARTIFACT_TTL)), 7 * 24 * 60 * 60)
+S3_TIMEOUT = float(os.environ.get('SONIFY_S3_TIMEOUT', 60))
+
+EMPTY_SHA256 = hashlib.sha256(b'').hexdigest()
+S3_NAMESPACE = '{http://s3.amazonaws.com/doc/2006-03-01/}'
+
+
+class LocalStorage:
+  # the job directory is already where next.js serves it from
+  async def publish(self, job_id: str, filename: str = VIDEO_FILENAME) -> str:
+    return get_job_url(job_id, filename)
+
+  async def delete(self, job_id: str):
+    pass # the job directory goes with the local sweep
+
+  async def expire(self, ttl: int) -> int:
+    return 0
+
+
+class S3Storage:
+  def __init__(self, endpoint: str = S3_ENDPOINT, bucket: str = S3_BUCKET, region: str = S3_REGION,
+               access_key: str = S3_ACCESS_KEY, secret_key: str = S3_SECRET_KEY, prefix: str = S3_PREFIX,
+               part_size: int = S3_PART_SIZE):
+    self.endpoint = endpoint.rstrip('/')
+    self.host = urlsplit(self.endpoint).netloc
+    self.bucket = bucket
+    self.region = region
+    self.access_key = access_key
+    self.secret_key = secret_key
+    self.prefix = prefix
+    self.part_size = part_size
+    self._client = None
+
+  def get_client(self) -> httpx.AsyncClient:
+    if self._client is None:
+      self._client = httpx.AsyncClient(timeout=S3_TIMEOUT)
+    return self._client
+
+  async def close(self):
+    if self._client is not None:
+      await self._client.aclose()
+      self._client = None
+
+  # requests are path style (endpoint/bucket/key), which every s3 clone
+  # understands, and signed with aws signature v4
+  def _path(self, key: str = '') -> str:
+    return quote(f'/{self.bucket}/{key}', safe='/-_.~')
+
+  def _signature(self, method: str, path: str, query: dict, headers: dict, payload_hash: str, now):
+    amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+    scope = f'{now:%Y%m%d}/{self.region}/s3/aws4_request'
+    canonical_query = '&'.join(f'{quote(k, safe="-_.~")}={quote(str(v), safe="-_.~")}' for k, v in sorted(query.items()))
+    signed_headers = ';'.join(sorted(headers))
+    canonical_headers = ''.join(f'{name}:{str(headers[name]).strip()}\n' for name in sorted(headers))
+    canonical_request = '\n'.join((method, path, canonical_query, canonical_headers, signed_headers, payload_hash))
+    string_to_sign = '\n'.join(('AWS4-HMAC-SHA256', amz_date, scope, hashlib.sha256(canonical_request.encode()).hexdigest()))
+
+    key = f'AWS4{self.secret_key}'.encode()
+    for part in (f'{now:%Y%m%d}', self.region, 's3', 'aws4_request'):
+      key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+    return hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest(), scope, signed_headers
+
+  async def _request(self, method: str, key: str = '', query: dict = None, body: bytes = b'', headers: dict = None) -> httpx.Response:
+    query = query or {}
+    now = datetime.datetime.now(datetime.timezone.utc)
+    path = self._path(key)
+    payload_hash = hashlib.sha256(body).hexdigest() if body else EMPTY_SHA256
+    headers = {'host': self.host, 'x-amz-content-sha256': payload_hash, 'x-amz-date': now.strftime('%Y%m%dT%H%M%SZ'), **(headers or {})}
+    signature, scope, signed_headers = self._signature(method, path, query, headers, payload_hash, now)
+    headers['authorization'] = (f'AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, '
+                                f'SignedHeaders={signed_headers}, Signature={signature}')
+
+    response = await self.get_client().request(method, f'{self.endpoint}{path}', params=query, headers=headers, content=body)
+    if response.status_code >= 300:
+      raise RuntimeError(f'Error from object storage ({response.status_code}) for {method} {key}: {response.text}')
+    return response
+
+  def presign(self, key: str, expires: int = S3_URL_EXPIRY) -> str:
+    # a GET anyone holding the url can make until it expires
+    now = datetime.datetime.now(datetime.timezone.utc)
+    path = self._path(key)
+    query = {
+      'X-Amz-Algorithm': 'AWS4-HMAC-SHA256',
+      'X-Amz-Credential': f'{self.access_key}/{now:%Y%m%d}/{self.region}/s3/aws4_request',
+      'X-Amz-Date': now.strftime('%Y%m%dT%H%M%SZ'),
+      'X-Amz-Expires': str(expires),
+      'X-Amz-SignedHeaders': 'host',
+    }
+    signature, _, _ = self._signature('GET', path, query, {'host': self.host}, 'UNSIGNED-PAYLOAD', now)
+    query['X-Amz-Signature'] = signature
+    return f'{self.endpoint}{path}?' + '&'.join(f'{k}={quote(v, safe="-_.~")}' for k, v in sorted(query.items()))
+
+  async def upload(self, file_path: str, key: str):
+    """
+    Upload file_path to key. Anything over one part is sent as a multipart
+    upload read from disk a part at a time, so memory use stays at one part
+    whatever the size of the video.
+    """
+    # so browsers play the video instead of downloading it
+    headers = {'content-type': mimetypes.guess_type(key)[0] or 'application/octet-stream'}
+    with open(file_path, 'rb') as f:
+      part = await asyncio.to_thread(f.read, self.part_size)
+      if len(part) < self.part_size:
+        await self._request('PUT', key, body=part, headers=headers)
+        return
+
+      response = await self._request('POST', key, {'uploads': ''}, headers=headers)
+      upload_id = ET.fromstring(response.content).findtext(f'{S3_NAMESPACE}UploadId')
+      try:
+        etags = []
+        while part:
+          response = await self._request('PUT', key, {'partNumber': len(etags) + 1, 'uploadId': upload_id}, part)
+          etags.append(response.headers['etag'])
+          part = await asyncio.to_thread(f.read, self.part_size)
+
+        parts = ''.join(f'<Part><PartNumber>{i + 1}</PartNumber><ETag>{etag}</ETag></Part>' for i, etag in enumerate(etags))
+        await self._request('POST', key, {'uploadId': upload_id},
+                            f'<CompleteMultipartUpload>{parts}</CompleteMultipartUpload>'.encode())
+      except BaseException:
+        # don't leave the uploaded parts behind (they're billed until aborted)
+        await self._request('DELETE', key, {'uploadId': upload_id})
+        raise
+
+  async def list_objects(self, prefix: str):
+    # (key, last modified timestamp) of everything under prefix
+    token = None
+    while True:
+      query = {'list-type': '2', 'prefix': prefix}
+      if token:
+        query['continuation-token'] = token
+      root = ET.fromstring((await self._request('GET', query=query)).content)
+      for item in root.iter(f'{S3_NAMESPACE}Contents'):
+        modified = datetime.datetime.fromisoformat(item.findtext(f'{S3_NAMESPACE}LastModified').replace('Z', '+00:00'))
+        yield item.findtext(f'{S3_NAMESPACE}Key'), modified.timestamp()
+      token = root.findtext(f'{S3_NAMESPACE}NextContinuationToken')
+      if root.findtext(f'{S3_NAMESPACE}IsTruncated') != 'true' or not token:
+        return
+
+  async def publish(self, job_id: str, filename: str = VIDEO_FILENAME) -> str:
+    key = f'{self.prefix}{job_id}/{filename}'
+    await self.upload(get_job_file(job_id, filename), key)
+    return self.presign(key)
+
+  async def delete(self, job_id: str):
+    # anything else would list (and delete) under another prefix
+    if not JOB_ID_PATTERN.match(job_id or ''):
+      raise ValueError(f'invalid job id: {job_id}')
+    async for key, _ in self.list_objects(f'{self.prefix}{job_id}/'):
+      await self._request('DELETE', key)
+
+  async def expire(self, ttl: int) -> int:
+    cutoff = time.time() - ttl
+    expired = [key async for key, modified in self.list_objects(self.prefix) if modified < cutoff]
+    for key in expired:
+      await self._request('DELETE', key)
+    return len(expired)
+
+
+def get_storage(backend: str = STORAGE_BACKEND):
+  if backend == 'local':
+    return LocalStorage()
+  if backend == 's3':
+    return S3Storage()
+  raise ValueError(f'unknown storage backend: {backend}')
+
+storage = get_storage()
+
+async def publish_artifact(job_id: str, filename: str = VIDEO_FILENAME) -> str:
+  # url the client fetches the finished file from. hls and dash playlists
+  # point at their segments by relative path, which a presigned url can't
+  # cover, so those are always served by the api from the job directory
+  if filename != VIDEO_FILENAME and filename in OUTPUT_FILENAMES.values():
+    return get_job_url(job_id, filename)
+  return await storage.publish(job_id, filename)
+
+
+# GARBAGE COLLECTION
+def last_write(directory: str) -> float:
+  # a long render keeps writing to its files without touching the directory
+  times = [os.stat(directory).st_mtime]
+  for entry in os.scandir(directory):
+    try:
+      times.append(entry.stat().st_mtime)
+    except FileNotFoundError:
+      pass # renamed or removed while we looked
+  return max(times)
+
+def expire_job_dirs(ttl: int) -> int:
+  # job directories nothing has been written to for ttl seconds
+  cutoff = time.time() - ttl
+  expired = 0
+  try:
+    entries = list(os.scandir(OUTPUT_DIR))
+  except FileNotFoundError:
+    return 0
+  for entry in entries:
+    if not entry.is_dir() or not JOB_ID_PATTERN.match(entry.name):
+      continue
+    if last_write(entry.path) < cutoff:
+      shutil.rmtree(entry.path, ignore_errors=True)
+      expired += 1
+  return expired
+
+async def collect_garbage(ttl: int = ARTIFACT_TTL):
+  job_dirs = await asyncio.to_thread(expire_job_dirs, ttl)
+  artifacts = await storage.expire(ttl)
+  if job_dirs or artifacts:
+    print(f'expired {job_dirs} job directories and {artifacts} stored artifacts')
+
+async def collect_garbage_forever(interval: int = GC_INTERVAL):
+  while True:
+    try:
+      await collect_garbage()
+    except Exception as e:
+      print(f'error collecting expired artifacts: {e}')
+    await asyncio.sleep(interval)
+
+async def close_storage():
+  if isinstance(storage, S3Storage):
+    await storage.close()
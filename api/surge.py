@@ -0,0 +1,168 @@
+# surge synthesis
+# both pipelines hold one note and bend the global pitch to follow the data,
+# one video frame of audio per data point. the renderer works out up front
+# which block every frame starts at and what pitch it gets, then lets surge
+# render whole frames into one preallocated buffer.
+# creating a synth and loading a patch costs more than most renders, so
+# every render worker keeps the synths it made and reuses them
+import os
+import sys
+import threading
+from contextlib import contextmanager
+import numpy as np
+from api.audio import SAMPLE_RATE
+
+NOTE = 60 # middle c
+VELOCITY = 127
+PITCH_RANGE = 7 # data is mapped to -7 ... +7
+
+# idle synths kept per sample rate and patch, in each render worker
+SURGE_POOL_SIZE = int(os.environ.get('SONIFY_SURGE_POOL_SIZE', 2))
+SILENCE = 1e-5
+RESET_MAX_BLOCKS = 4096 # ~3s at 44.1kHz, enough for any release tail
+
+
+def import_surgepy(surge_path: str = None):
+  # surgepy isn't on pypi, users point us at their build of the bindings
+  if surge_path:
+    surge_path = os.path.normpath(surge_path)
+    if os.path.exists(surge_path):
+      if surge_path not in sys.path:
+        sys.path.append(surge_path)
+        print(f'Added surge path to system: {surge_path}')
+    else:
+      print(f'Warning: Provided surge path does not exist: {surge_path}')
+  import surgepy
+  return surgepy
+
+def get_pitch_param(surge):
+  from surgepy import constants as srgco
+  cg_Global = surge.getControlGroup(srgco.cg_GLOBAL)
+  globalEnts = cg_Global.getEntries()
+  globalPar = globalEnts[1].getParams()
+  return globalPar[1] # global scene pitch parameter
+
+
+class SurgeInstance:
+  # a synth with its patch loaded and the parameter handles looked up once
+  def __init__(self, surgepy, sample_rate: int, patch_path: str = None):
+    self.surge = surgepy.createSurge(sample_rate)
+    self.sample_rate = sample_rate
+    if patch_path:
+      try:
+        print(f'Loading patch from: {patch_path}')
+        self.surge.loadPatch(patch_path)
+      except Exception as e:
+        print(f'Error loading patch: {e}')
+    self.pitch = get_pitch_param(self.surge)
+    self.pitch_default = self.surge.getParamVal(self.pitch)
+
+  def reset(self):
+    # back to how the patch left it: no notes held, pitch centered and the
+    # release tail rung out, so the next render starts from silence
+    surge = self.surge
+    if hasattr(surge, 'allNotesOff'):
+      surge.allNotesOff()
+    surge.setParamVal(self.pitch, self.pitch_default)
+    for _ in range(RESET_MAX_BLOCKS):
+      surge.process()
+      if np.max(np.abs(surge.getOutput())) < SILENCE:
+        break
+
+
+class SurgePool:
+  def __init__(self, max_idle: int = SURGE_POOL_SIZE):
+    self.max_idle = max_idle
+    self._idle = {} # (sample_rate, patch_path) -> [SurgeInstance]
+    self._lock = threading.Lock()
+    self.created = 0
+    self.reused = 0
+
+  @contextmanager
+  def acquire(self, surgepy, sample_rate: int = SAMPLE_RATE, patch_path: str = None):
+    key = (sample_rate, patch_path)
+    with self._lock:
+      idle = self._idle.get(key)
+      instance = idle.pop() if idle else None
+      if instance is None:
+        self.created += 1
+      else:
+        self.reused += 1
+    if instance is None:
+      print('Creating Surge instance...')
+      instance = SurgeInstance(surgepy, sample_rate, patch_path)
+
+    # a render that failed leaves the synth in an unknown state, so it is
+    # only handed back after a clean render
+    yield instance
+
+    instance.reset()
+    with self._lock:
+      idle = self._idle.setdefault(key, [])
+      if len(idle) < self.max_idle:
+        idle.append(instance)
+
+  def stats(self):
+    with self._lock:
+      return {
+        'idle': sum(len(idle) for idle in self._idle.values()),
+        'created': self.created,
+        'reused': self.reused,
+      }
+
+
+surge_pool = SurgePool()
+
+
+def frame_blocks(num_frames: int, fps: int, sample_rate: int, block_size: int):
+  """
+  Block index each frame starts at (plus the end of the last frame) and the
+  exact number of samples in the video's duration. Frames don't divide into
+  whole blocks, so the boundaries are rounded per frame instead of per
+  frame length, which would drift (and used to drop the remainder).
+  """
+  total_samples = int(round(num_frames * sample_rate / fps))
+  frame_starts = np.round(np.arange(num_frames + 1) * sample_rate / fps)
+  # parameters can only change between blocks, take the nearest boundary
+  blocks = np.round(frame_starts / block_size).astype(np.int64)
+  blocks[-1] = -(-total_samples // block_size)
+  return blocks, total_samples
+
+def pitch_values(y) -> np.ndarray:
+  # data scaled to the pitch bend range
+  y = np.asarray(y, dtype=np.float64)
+  value_range = np.nanmax(y) - np.nanmin(y)
+  normalized = (y - np.nanmin(y)) / value_range if value_range > 0 else np.full(len(y), 0.5)
+  return np.nan_to_num(normalized, nan=0.5) * PITCH_RANGE * 2 - PITCH_RANGE
+
+def render_pitch_track(surge, pitch, y, fps: int, sample_rate: int = SAMPLE_RATE) -> np.ndarray:
+  """
+  Render the held note with the pitch following y, one frame per point.
+  Returns float samples of exactly len(y) / fps seconds.
+  """
+  block_size = surge.getBlockSize()
+  blocks, total_samples = frame_blocks(len(y), fps, sample_rate, block_size)
+  pitches = pitch_values(y)
+  num_blocks = int(blocks[-1])
+
+  surge.playNote(0, NOTE, VELOCITY, 0)
+  if hasattr(surge, 'processMultiBlock'):
+    # surge renders every block of a frame in one call, straight into the buffer
+    output = surge.createMultiBlock(num_blocks)
+    for i in range(len(pitches)):
+      if blocks[i + 1] > blocks[i]:
+        surge.setParamVal(pitch, pitches[i])
+        surge.processMultiBlock(output, int(blocks[i]), int(blocks[i + 1] - blocks[i]))
+    samples = output[0]
+  else:
+    # older bindings, one block per call but still no per block allocation
+    output = np.empty((num_blocks, block_size), dtype=np.float32)
+    for i in range(len(pitches)):
+      surge.setParamVal(pitch, pitches[i])
+      for block in range(blocks[i], blocks[i + 1]):
+        surge.process()
+        output[block] = surge.getOutput()[0]
+    samples = output.ravel()
+  surge.releaseNote(0, NOTE, 0)
+
+  return samples[:total_samples]
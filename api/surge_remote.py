@@ -0,0 +1,73 @@
+# remote surge client
+# renders on the remote surge server (e.g. a raspberry pi running surge) are
+# requested from the event loop, so waiting on the network never ties up a
+# render worker. every request shares one pool of keep-alive connections and
+# the wav that comes back is streamed into the job directory as it arrives
+import asyncio
+import os
+import httpx
+
+SURGE_REMOTE_URL = os.environ.get('SONIFY_SURGE_REMOTE_URL', 'http://localhost:8888')
+# seconds to connect, and to wait for each chunk of the response
+SURGE_REMOTE_CONNECT_TIMEOUT = float(os.environ.get('SONIFY_SURGE_REMOTE_CONNECT_TIMEOUT', 5))
+SURGE_REMOTE_TIMEOUT = float(os.environ.get('SONIFY_SURGE_REMOTE_TIMEOUT', 30))
+# retries after the first attempt, waiting SURGE_REMOTE_BACKOFF seconds and doubling each time
+SURGE_REMOTE_RETRIES = int(os.environ.get('SONIFY_SURGE_REMOTE_RETRIES', 2))
+SURGE_REMOTE_BACKOFF = float(os.environ.get('SONIFY_SURGE_REMOTE_BACKOFF', 0.5))
+SURGE_REMOTE_CONNECTIONS = int(os.environ.get('SONIFY_SURGE_REMOTE_CONNECTIONS', 10))
+
+CHUNK_SIZE = 64 * 1024
+# the server is busy or restarting, worth another try
+RETRY_STATUS_CODES = (502, 503, 504)
+
+_client = None
+
+
+def get_client() -> httpx.AsyncClient:
+  global _client
+  if _client is None:
+    _client = httpx.AsyncClient(
+      timeout=httpx.Timeout(SURGE_REMOTE_TIMEOUT, connect=SURGE_REMOTE_CONNECT_TIMEOUT),
+      limits=httpx.Limits(max_connections=SURGE_REMOTE_CONNECTIONS, max_keepalive_connections=SURGE_REMOTE_CONNECTIONS),
+    )
+  return _client
+
+async def close_client():
+  global _client
+  if _client is not None:
+    await _client.aclose()
+    _client = None
+
+async def fetch_remote_audio(remote_url: str, endpoint: str, payload: dict, file_path: str) -> str:
+  """
+  POST payload to remote_url/endpoint and stream the wav it sends back to
+  file_path. Connection errors and busy servers are retried with backoff,
+  any other error response raises straight away.
+  """
+  url = f'{(remote_url or SURGE_REMOTE_URL).rstrip("/")}/{endpoint}'
+  temp_path = f'{file_path}.part'
+  try:
+    for attempt in range(SURGE_REMOTE_RETRIES + 1):
+      try:
+        async with get_client().stream('POST', url, json=payload) as response:
+          if response.status_code == 200:
+            # a half written file never gets the real name
+            with open(temp_path, 'wb') as f:
+              async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                f.write(chunk)
+            os.replace(temp_path, file_path)
+            return file_path
+
+          body = (await response.aread()).decode(errors='replace')
+          error = RuntimeError(f'Error from remote Surge server ({response.status_code}): {body}')
+          if response.status_code not in RETRY_STATUS_CODES:
+            raise error
+      except httpx.TransportError as e:
+        error = RuntimeError(f'Could not reach remote Surge server at {url}: {e!r}')
+
+      if attempt < SURGE_REMOTE_RETRIES:
+        await asyncio.sleep(SURGE_REMOTE_BACKOFF * 2 ** attempt)
+    raise error
+  finally:
+    if os.path.exists(temp_path):
+      os.remove(temp_path)
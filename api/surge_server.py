@@ -0,0 +1,187 @@
+# remote surge render server
+# the server the surge-remote audio option talks to, so audio synthesis can
+# run on its own machines (e.g. one with surge installed) and scale apart
+# from video rendering. it uses the same synthesis code as surge-local.
+#
+#   SONIFY_SURGE_PATH=/path/to/surge-python python3 -m uvicorn api.surge_server:app --port 8888
+#
+# requests go onto a bounded queue that a fixed number of workers drain,
+# each worker handing the render to its own process (which keeps its surge
+# synths warm). identical payloads that arrive while one is being rendered
+# share that render instead of queueing another
+import asyncio
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+import numpy as np
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import Response
+from pydantic import BaseModel
+from api.audio import SAMPLE_RATE, write_wav
+
+SURGE_PATH = os.environ.get('SONIFY_SURGE_PATH', '')
+SURGE_SERVER_WORKERS = int(os.environ.get('SONIFY_SURGE_SERVER_WORKERS', os.cpu_count() or 1))
+SURGE_SERVER_QUEUE_DEPTH = int(os.environ.get('SONIFY_SURGE_SERVER_QUEUE_DEPTH', SURGE_SERVER_WORKERS * 4))
+
+
+class MathAudioRequest(BaseModel):
+  function: str
+  x_range_start: float = 0
+  x_range_end: float = 25 * np.pi
+  num_data_points: int = 400
+  fps: int = 30
+
+class StocksAudioRequest(BaseModel):
+  ticker: str = ''
+  prices: List[float]
+  fps: int = 30
+
+
+# render functions run in the worker processes and return wav bytes
+def wav_bytes(samples) -> bytes:
+  buffer = io.BytesIO()
+  write_wav(buffer, samples, SAMPLE_RATE)
+  return buffer.getvalue()
+
+def render_math_audio(payload: dict) -> bytes:
+  from api.math_wave_sonification import evaluate_function, synthesize_surge_local
+  from api.utils import MathWaveSonificationConfig
+
+  config = MathWaveSonificationConfig(surgePath=SURGE_PATH, **payload)
+  x, y = evaluate_function(config)
+  return wav_bytes(synthesize_surge_local(config, y))
+
+def render_stocks_audio(payload: dict) -> bytes:
+  from api.stocks_sonification import synthesize_stocks_surge_local
+  from api.utils import StocksSonificationConfig
+
+  config = StocksSonificationConfig(ticker=payload['ticker'] or 'SPY', fps=payload['fps'], surgePath=SURGE_PATH)
+  return wav_bytes(synthesize_stocks_surge_local(config, np.asarray(payload['prices'], dtype=np.float64)))
+
+RENDERERS = {
+  'math_audio': render_math_audio,
+  'stocks_audio': render_stocks_audio,
+}
+
+
+class QueueFull(Exception):
+  pass
+
+
+class RenderQueue:
+  def __init__(self, workers: int = SURGE_SERVER_WORKERS, queue_depth: int = SURGE_SERVER_QUEUE_DEPTH):
+    self.workers = workers
+    self.queue_depth = queue_depth
+    self._queue = None
+    self._executor = None
+    self._tasks = []
+    self._pending = {} # payload hash -> future shared by identical requests
+    self.metrics = {
+      'requests': 0,
+      'coalesced': 0,
+      'rejected': 0,
+      'completed': 0,
+      'failed': 0,
+      'render_seconds': 0.0,
+    }
+
+  def start(self):
+    self._queue = asyncio.Queue(maxsize=self.queue_depth)
+    # spawn so workers don't inherit the server's threads and event loop
+    self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+    self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+  async def stop(self):
+    for task in self._tasks:
+      task.cancel()
+    await asyncio.gather(*self._tasks, return_exceptions=True)
+    self._tasks = []
+    self._executor.shutdown(wait=False, cancel_futures=True)
+
+  async def submit(self, kind: str, payload: dict) -> bytes:
+    self.metrics['requests'] += 1
+    key = hashlib.sha256(json.dumps({'kind': kind, 'payload': payload}, sort_keys=True).encode()).hexdigest()
+
+    future = self._pending.get(key)
+    if future is not None:
+      self.metrics['coalesced'] += 1
+    else:
+      future = asyncio.get_running_loop().create_future()
+      try:
+        self._queue.put_nowait((kind, payload, key, future))
+      except asyncio.QueueFull:
+        self.metrics['rejected'] += 1
+        raise QueueFull(f'render queue is full ({self._queue.qsize()} renders waiting)')
+      self._pending[key] = future
+
+    # shielded so one client hanging up doesn't cancel the render for the others
+    return await asyncio.shield(future)
+
+  async def _work(self):
+    loop = asyncio.get_running_loop()
+    while True:
+      kind, payload, key, future = await self._queue.get()
+      started = time.perf_counter()
+      try:
+        result = await loop.run_in_executor(self._executor, RENDERERS[kind], payload)
+        self.metrics['completed'] += 1
+        future.set_result(result)
+      except asyncio.CancelledError:
+        future.cancel()
+        raise
+      except Exception as e:
+        print(f'error rendering {kind}: {e}')
+        self.metrics['failed'] += 1
+        future.set_exception(e)
+      finally:
+        self.metrics['render_seconds'] += time.perf_counter() - started
+        self._pending.pop(key, None)
+        self._queue.task_done()
+
+  def stats(self):
+    return {
+      'workers': self.workers,
+      'queue_depth': self.queue_depth,
+      'queued': self._queue.qsize() if self._queue else 0,
+      'in_flight': len(self._pending),
+      **self.metrics,
+    }
+
+
+app = FastAPI()
+render_queue = RenderQueue()
+
+@app.on_event('startup')
+async def startup():
+  render_queue.start()
+
+@app.on_event('shutdown')
+async def shutdown():
+  await render_queue.stop()
+
+async def render(kind: str, payload: dict):
+  try:
+    wav = await render_queue.submit(kind, payload)
+  except QueueFull as e:
+    # the client retries 503s with backoff
+    raise HTTPException(status_code=503, detail=str(e))
+  except Exception as e:
+    raise HTTPException(status_code=500, detail=f'{type(e).__name__}: {e}')
+  return Response(content=wav, media_type='audio/wav')
+
+@app.get('/health')
+async def health():
+  return {'status': 'ok', 'surge_path': SURGE_PATH, 'renders': render_queue.stats()}
+
+@app.post('/math_audio')
+async def math_audio(request: MathAudioRequest):
+  return await render('math_audio', request.model_dump())
+
+@app.post('/stocks_audio')
+async def stocks_audio(request: StocksAudioRequest):
+  return await render('stocks_audio', request.model_dump())
@@ -1,36 +1,140 @@
 from fastapi import UploadFile, File
 from PIL import Image
 import numpy as np
-import io
-from tones import SINE_WAVE
-from tones.mixer import Mixer
-from moviepy.editor import VideoFileClip, AudioFileClip
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
+import asyncio
 import os
-from pathlib import Path
-
-
-# step 1. do everything
-async def create_translation(file: UploadFile = File(...)):
-  # read the image
-  image_data = await file.read()
+from typing import NamedTuple
+from api.audio import NOTE_FREQUENCIES, note_frequencies, normalize_samples, synthesize_notes, synthesize_spectrogram, write_wav
+from api.executor import run_in_pool
+from api.media import combine_files, get_writer
+from api.progress import ProgressWriter
+from api.render_cache import render_cache, new_cache_digest
+from api.segments import render_segmented
+from api.utils import (
+  ANIMATION_FILENAME, AUDIO_FILENAME, VIDEO_FILENAME, new_job_id, get_job_file, delete_job_dir, output_filename
+)
+
+# every scanline is a frame (and a note), so images are scaled down to at
+# most this many rows before anything else happens. render time and memory
+# then depend on these limits instead of the upload's resolution
+TRANSLATION_MAX_SCANLINES = int(os.environ.get('SONIFY_TRANSLATION_MAX_SCANLINES', 600)) # 20s at 30 fps
+TRANSLATION_MAX_WIDTH = int(os.environ.get('SONIFY_TRANSLATION_MAX_WIDTH', 1024))
+# pixels an upload may decode to. jpegs are decoded scaled down, so this
+# only turns away huge pngs and the like, which are decoded whole
+TRANSLATION_MAX_PIXELS = int(os.environ.get('SONIFY_TRANSLATION_MAX_PIXELS', 40_000_000))
+UPLOAD_FILENAME = 'upload'
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+ROW_BATCH = 256 # rows per vectorized batch
+TRANSLATION_FPS = 30
+TRANSLATION_BANDS = 8 # vertical bands band_energy is measured over
+
+# 'rich' plays every column at once (one partial per column band, left is
+# low, right is high, louder the brighter), 'scanline' plays one note per
+# row from its average brightness
+TRANSLATION_MODES = ('rich', 'scanline')
+TRANSLATION_MODE = os.environ.get('SONIFY_TRANSLATION_MODE', 'rich')
+
+# scanline notes
+NUM_NOTES = 12 * (9 - 2 * 2) # same range as the stocks and math tones
+TRANSLATION_ATTACK = 0.1
+TRANSLATION_DECAY = 0.1
+
+# rich mode partials, a semitone apart from c3 up
+RICH_PARTIALS = 60
+RICH_FREQUENCIES = NOTE_FREQUENCIES[np.arange(RICH_PARTIALS) % 12] * np.power(2.0, np.arange(RICH_PARTIALS) // 12 - 1)
+
+
+def load_scanlines(image_path: str, max_scanlines: int = TRANSLATION_MAX_SCANLINES,
+                   max_width: int = TRANSLATION_MAX_WIDTH) -> np.ndarray:
+  # grayscale pixels, already scaled down to the output size
+  with Image.open(image_path) as image:
+    width, height = image.size
+    scale = min(1.0, max_scanlines / height, max_width / width)
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+
+    # jpegs decode straight to grayscale at 1/2, 1/4 or 1/8 scale
+    image.draft('L', size)
+    # image.size is now what will actually be decoded
+    if image.size[0] * image.size[1] > TRANSLATION_MAX_PIXELS:
+      raise ValueError(f'image is too large: {width}x{height} (at most {TRANSLATION_MAX_PIXELS} pixels)')
+    if image.mode not in ('L', 'RGB', 'RGBA'):
+      image = image.convert('L')
+    # box filtered integer reductions first, so the full resolution image
+    # is never resampled (or converted) as a whole
+    if image.size != size:
+      image = image.resize(size, Image.Resampling.BOX, reducing_gap=3.0)
+    return np.asarray(image.convert('L')) # L means grayscale
+
+class ScanlineFeatures(NamedTuple):
+  brightness: np.ndarray # mean of every row, 0 - 1
+  band_energy: np.ndarray # (rows, bands) mean squared brightness of each vertical band of a row
+  contrast: np.ndarray # rms contrast (standard deviation) of every row, 0 - 1
+
+def scanline_features(scanlines: np.ndarray, num_bands: int = TRANSLATION_BANDS) -> ScanlineFeatures:
+  # everything the synths need, for the whole image in one pass over the
+  # pixels (a batch of rows at a time, to bound the float temporaries)
+  rows, width = scanlines.shape
+  num_bands = min(num_bands, width)
+  edges = np.linspace(0, width, num_bands + 1).astype(np.int64)
+  band_widths = np.diff(edges)
+
+  brightness = np.empty(rows)
+  contrast = np.empty(rows)
+  band_energy = np.empty((rows, num_bands))
+  for start in range(0, rows, ROW_BATCH):
+    batch = scanlines[start:start + ROW_BATCH].astype(np.float32) / 255
+    squared = batch * batch
+    mean = batch.mean(axis=1)
+    brightness[start:start + ROW_BATCH] = mean
+    contrast[start:start + ROW_BATCH] = np.sqrt(np.maximum(squared.mean(axis=1) - mean * mean, 0))
+    band_energy[start:start + ROW_BATCH] = np.add.reduceat(squared, edges[:-1], axis=1) / band_widths
+  return ScanlineFeatures(brightness, band_energy, contrast)
+
+def synthesize_translation(features: ScanlineFeatures, fps: int = TRANSLATION_FPS) -> np.ndarray:
+  # one note per scanline (bottom to top, like the line), higher and louder
+  # the brighter the row. flat rows play at half the volume of busy ones
+  # (contrast is at most 0.5), so edges and texture stand out
+  brightness = features.brightness[::-1]
+  amplitudes = np.clip(brightness * (0.5 + features.contrast[::-1]), 0, 1)
+  note_indices = (brightness * (NUM_NOTES - 1)).astype(np.int64)
+  return synthesize_notes(note_frequencies(note_indices, NUM_NOTES), amplitudes, 1 / fps,
+                          attack=TRANSLATION_ATTACK, decay=TRANSLATION_DECAY)
+
+def synthesize_rich_translation(features: ScanlineFeatures, fps: int = TRANSLATION_FPS) -> np.ndarray:
+  # every scanline is a spectrum frame: the rms brightness of each column
+  # band is the amplitude of its partial. the whole image is a handful of
+  # inverse ffts instead of thousands of tracks
+  magnitudes = np.sqrt(features.band_energy[::-1])
+  frequencies = RICH_FREQUENCIES
+  if magnitudes.shape[1] != RICH_PARTIALS:
+    # images narrower than RICH_PARTIALS columns get fewer partials over the same range
+    frequencies = np.geomspace(RICH_FREQUENCIES[0], RICH_FREQUENCIES[-1], magnitudes.shape[1])
+  return normalize_samples(synthesize_spectrogram(magnitudes, frequencies, fps))
+
+
+# the stages run in the render pool. decoding comes first, then animation
+# and audio are rendered at the same time, then combined
+def decode_translation(image_path: str, max_scanlines: int = TRANSLATION_MAX_SCANLINES) -> np.ndarray:
+  image = load_scanlines(image_path, max_scanlines)
+  # the upload isn't needed once it's decoded
+  os.remove(image_path)
+  return image
+
+def render_translation_audio(image: np.ndarray, job_id: str, mode: str = TRANSLATION_MODE):
+  if mode == 'rich':
+    samples = synthesize_rich_translation(scanline_features(image, RICH_PARTIALS))
+  else:
+    samples = synthesize_translation(scanline_features(image))
+  write_wav(get_job_file(job_id, AUDIO_FILENAME), samples)
+  return {'status': 'success'}
 
-  # convert the image into a numpy array
-  image = np.array(Image.open(io.BytesIO(image_data)).convert('L')) # L means grayscale
+def render_translation_animation(image: np.ndarray, file_path: str, start: int = 0, end: int = None):
+  # start and end pick a run of frames, for rendering in segments
   height, width = image.shape
-
-  # set up audio mixer
-  sample_rate = 44100
-  fps = 30
+  fps = TRANSLATION_FPS
   interval = 1000 // fps
-  video_time = interval * height
-  mixer = Mixer(sample_rate=sample_rate, amplitude=0.5)
-  mixer.create_track(0, SINE_WAVE, attack=0.1, decay=0.1)
-  diff = 2
-  notes = ['c', 'c#', 'd', 'd#', 'e', 'f', 'f#', 'g', 'g#', 'a', 'a#', 'b'] * (9 - 2 * diff)
-  def clamp(j, diff): # returns inner values (diff inside 9)
-    return max(min(len(notes) // 12, j // 12 + diff), j // 12 - diff)
 
   # set up fig and axis
   fig, ax = plt.subplots()
@@ -42,9 +146,6 @@ async def create_translation(file: UploadFile = File(...)):
   wave_amplitude = np.zeros(width)
   wave, = ax.plot(x, wave_amplitude, color='r', lw=2)
 
-  #for i in range(height + 1):
-  #    mixer.create_track(i, SINE_WAVE, attack=0.1, decay=0.1)
-
   # update horizontal line's vertical position every frame
   def animate(n):
     # line reaches the top of the image
@@ -54,71 +155,79 @@ async def create_translation(file: UploadFile = File(...)):
     row = image[height - n - 1, :]
     wave_amplitude = ((255 - row) / 255.0) * 20 - 10
     wave.set_ydata(wave_amplitude + height - n - 1)
-
-    """
-    # generate audio for the current row
-    for i, brightness in enumerate(set(row)):
-      note_index = int(np.interp(i, [0, width], [0, len(notes) - 1]))
-      mixer.add_note(i, note=notes[note_index], octave=clamp(note_index, diff), amplitude=brightness / 255.0, duration=0.01)
-    """
-    average_brightness = np.mean(row)
-    note_index = int(np.interp(average_brightness, [0, 255], [0, len(notes) - 1]))
-    mixer.add_note(0, note=notes[note_index], octave=clamp(note_index, diff), amplitude=average_brightness / 255.0, duration= 1 / height)
-
     return wave,
 
-  # make sure output directory exists
-  output_dir = 'public/animations'
-  os.makedirs(output_dir, exist_ok=True)
-
   # save animation
-  ani = animation.FuncAnimation(fig=fig, func=animate, frames=height + 1, interval=interval)
-  Writer = animation.writers['ffmpeg']
-  writer = Writer(fps=fps, metadata=dict(artist='Me'), bitrate=1800)
-  animation_filepath = os.path.join(output_dir, 'animation.mp4')
-  ani.save(animation_filepath, writer=writer)
-
-  
-  # finalize audio
-  #final_audio = np.concatenate(wave_audio)
-  mixer.mix()
-  mixer.write_wav(output_dir + '/tones.wav')
-  #print(final_audio)
-
-  # combine audio and video
-  video = VideoFileClip(output_dir + '/animation.mp4')
-  audio = AudioFileClip(output_dir + '/tones.wav')
-  combined = video.set_audio(audio)
-  combined.write_videofile(f'{output_dir}/translation_sonify.mp4', 
-                           codec='libx264',
-                           audio_codec='aac',
-                           temp_audiofile='temp-audio.m4a',
-                           remove_temp=True
-                           )
-
-  combined.close()
-  video.close()
-  audio.close()
+  frames = range(start, height + 1 if end is None else end)
+  ani = animation.FuncAnimation(fig=fig, func=animate, frames=frames, interval=interval)
+  writer = get_writer(fps)
+  progress = ProgressWriter(file_path, frames=0, total_frames=len(frames))
+  try:
+    ani.save(file_path, writer=writer, progress_callback=lambda i, n: progress.update(frames=i + 1))
+  finally:
+    plt.close(fig)
+  progress.update(force=True, frames=len(frames))
   return {'status': 'success'}
 
-async def delete_intermediate_translation_files():
-  animation_file = Path(f'public/animations/animation.mp4')
-  audio_file = Path(f'public/animations/tones.wav')
-  final_video_file = Path(f'public/animations/translation_sonify.mp4')
-
-   # put in list to iterate
-  to_delete = [animation_file, audio_file, final_video_file]
-
-  # iterate
-  for file_path in to_delete:
-    try:
-      # check if exists first
-      if file_path.exists():
-        # delete the file
-        file_path.unlink()
-        print(f'deleted: {file_path}')
-      
-      else:
-        print(f'file not found. skipping {file_path}')
-    except Exception as e:
-      print(f'error deleting {file_path}: {e}')
\ No newline at end of file
+def render_translation_combined(job_id: str, cache_key: str = None, output_format: str = 'mp4'):
+  # the animation's video track is copied over instead of encoded again
+  combine_files(get_job_file(job_id, ANIMATION_FILENAME), get_job_file(job_id, AUDIO_FILENAME),
+                get_job_file(job_id, output_filename(output_format)), output_format)
+
+  # the cache keeps single files, segmented outputs are rendered every time
+  if cache_key and output_format == 'mp4':
+    render_cache.store(cache_key, get_job_file(job_id, VIDEO_FILENAME))
+  return {'status': 'success', 'job_id': job_id}
+
+def translation_options(max_scanlines: int = None, mode: str = None, output_format: str = None):
+  # clients can ask for fewer scanlines (a shorter video), never more
+  if max_scanlines is None:
+    max_scanlines = TRANSLATION_MAX_SCANLINES
+  if max_scanlines <= 0:
+    raise ValueError(f'max_scanlines must be greater than 0, got {max_scanlines}')
+  max_scanlines = min(max_scanlines, TRANSLATION_MAX_SCANLINES)
+  mode = mode or TRANSLATION_MODE
+  output_format = output_format or 'mp4'
+  if mode not in TRANSLATION_MODES:
+    raise ValueError(f'unknown translation mode: {mode}')
+  output_filename(output_format) # raises for unknown formats
+  return max_scanlines, mode, output_format
+
+async def receive_translation(file: UploadFile, job_id: str, max_scanlines: int, mode: str):
+  # stream the upload to the job directory, hashing it on the way.
+  # returns the upload's path and its render cache key
+  upload_path = get_job_file(job_id, UPLOAD_FILENAME)
+  digest = new_cache_digest('translation')
+  with open(upload_path, 'wb') as f:
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+      f.write(chunk)
+      digest.update(chunk)
+  digest.update(f'{max_scanlines}x{TRANSLATION_MAX_WIDTH} {mode}'.encode())
+  return upload_path, digest.hexdigest()
+
+async def translate_upload(job_id: str, upload_path: str, cache_key: str, max_scanlines: int, mode: str,
+                           output_format: str = 'mp4'):
+  # same image uploaded before, hand out the cached video
+  if output_format == 'mp4' and render_cache.fetch(cache_key, get_job_file(job_id, VIDEO_FILENAME)):
+    os.remove(upload_path)
+    return {'status': 'success', 'job_id': job_id}
+
+  image = await run_in_pool(decode_translation, upload_path, max_scanlines)
+  # audio doesn't depend on the frames, so both render at the same time.
+  # tall images are animated in segments on several workers
+  await asyncio.gather(
+    render_segmented(render_translation_animation, (image,), len(image) + 1, get_job_file(job_id, ANIMATION_FILENAME)),
+    run_in_pool(render_translation_audio, image, job_id, mode),
+  )
+  return await run_in_pool(render_translation_combined, job_id, cache_key, output_format)
+
+async def create_translation(file: UploadFile = File(...), max_scanlines: int = None, mode: str = None,
+                             output_format: str = None):
+  job_id = new_job_id()
+  max_scanlines, mode, output_format = translation_options(max_scanlines, mode, output_format)
+  upload_path, cache_key = await receive_translation(file, job_id, max_scanlines, mode)
+  return await translate_upload(job_id, upload_path, cache_key, max_scanlines, mode, output_format)
+
+async def delete_intermediate_translation_files(job_id: str):
+  # everything for a job lives in its own directory
+  delete_job_dir(job_id)
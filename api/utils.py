@@ -1,7 +1,11 @@
 # math sonification configuration
 from typing import Optional, Dict, Any
+import os
+import re
+import shutil
+import uuid
 import numpy as np
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 
 # NOTES
@@ -24,11 +28,18 @@ class MathWaveSonificationConfig(BaseModel):
 
   # animation
   fps: Optional[int] = 30 # make sure greater than 0
+  animation_engine: Optional[str] = 'matplotlib' # 'matplotlib', or 'fast' to rasterize frames with numpy
+  output_format: Optional[str] = 'mp4' # combine step output: 'mp4', or 'hls' / 'dash' segments and a playlist
 
   # audio
   audioProcessing: Optional[str] = ''
   surgePath: Optional[str] = ''
   remoteURL: Optional[str] = ''
+  audio_only: Optional[bool] = False # one shot renders skip the animation and return just the audio
+  audio_format: Optional[str] = 'opus' # audio only output: 'opus', 'mp3', 'flac' or 'wav'
+
+  # job (handed out by the first step, sent back with every step after that)
+  job_id: Optional[str] = None
 
 
 
@@ -37,7 +48,13 @@ class StocksSonificationConfig(BaseModel):
   ticker: str = 'SPY'
 
   # general (here and below I just copied above so whenever changes are made there, reflect them here)
-  num_days: Optional[int] = 400 # needs to be yfinance compatible. so may not just be int, might need string too.
+  num_days: Optional[int] = 400 # calendar days of history, ending today or at end_date
+  start_date: Optional[str] = None # e.g. '2020-01-01', overrides num_days
+  end_date: Optional[str] = None
+  interval: Optional[str] = '1d' # yfinance bar size, e.g. '1m', '1h', '1d', '1wk'
+  max_frames: Optional[int] = Field(1000, ge=3) # longer series are downsampled to this many points (frames and notes), None keeps every point
+  downsample: Optional[str] = 'lttb' # 'lttb' or 'minmax'
+  data_source: Optional[str] = '' # 'yfinance' or 'local', empty uses the server default
   
   # related to plotting
   x_label: Optional[str] = "Time"
@@ -47,8 +64,68 @@ class StocksSonificationConfig(BaseModel):
 
   # animation
   fps: Optional[int] = 30 # make sure greater than 0
+  animation_engine: Optional[str] = 'matplotlib' # 'matplotlib', or 'fast' to rasterize frames with numpy
+  output_format: Optional[str] = 'mp4' # combine step output: 'mp4', or 'hls' / 'dash' segments and a playlist
 
   # audio
   audioProcessing: Optional[str] = ''
   surgePath: Optional[str] = ''
-  remoteURL: Optional[str] = ''
\ No newline at end of file
+  remoteURL: Optional[str] = ''
+  audio_only: Optional[bool] = False # one shot renders skip the animation and return just the audio
+  audio_format: Optional[str] = 'opus' # audio only output: 'opus', 'mp3', 'flac' or 'wav'
+
+  # job (handed out by the first step, sent back with every step after that)
+  job_id: Optional[str] = None
+
+
+# JOBS
+# every render gets its own directory under OUTPUT_DIR so concurrent requests
+# (and multiple uvicorn workers on the same box) never write to the same files
+OUTPUT_DIR = 'public/animations'
+ANIMATION_FILENAME = 'animation.mp4'
+AUDIO_FILENAME = 'tones.wav'
+VIDEO_FILENAME = 'sonification.mp4'
+# playlists of the segmented output formats
+OUTPUT_FILENAMES = {'mp4': VIDEO_FILENAME, 'hls': 'playlist.m3u8', 'dash': 'manifest.mpd'}
+# audio only renders
+AUDIO_FORMATS = ('opus', 'mp3', 'flac', 'wav')
+JOB_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+def new_job_id() -> str:
+  return uuid.uuid4().hex
+
+def ensure_job_id(config) -> str:
+  # older clients don't send a job id, so hand them a fresh one
+  if not config.job_id:
+    config.job_id = new_job_id()
+  return config.job_id
+
+def get_job_dir(job_id: str) -> str:
+  # job ids end up in file paths, so only accept the ones we hand out
+  if not JOB_ID_PATTERN.match(job_id or ''):
+    raise ValueError(f'invalid job id: {job_id}')
+  job_dir = os.path.join(OUTPUT_DIR, job_id)
+  os.makedirs(job_dir, exist_ok=True)
+  return job_dir
+
+def get_job_file(job_id: str, filename: str) -> str:
+  return os.path.join(get_job_dir(job_id), filename)
+
+def output_filename(output_format: str = 'mp4') -> str:
+  if output_format not in OUTPUT_FILENAMES:
+    raise ValueError(f'unknown output format: {output_format}')
+  return OUTPUT_FILENAMES[output_format]
+
+def audio_output_filename(audio_format: str = 'opus') -> str:
+  if audio_format not in AUDIO_FORMATS:
+    raise ValueError(f'unknown audio format: {audio_format}')
+  return f'sonification.{audio_format}'
+
+def get_job_url(job_id: str, filename: str = VIDEO_FILENAME) -> str:
+  # public/ is served as the site root by next.js
+  return f'/animations/{job_id}/{filename}'
+
+def delete_job_dir(job_id: str):
+  job_dir = get_job_dir(job_id)
+  shutil.rmtree(job_dir, ignore_errors=True)
+  print(f'deleted: {job_dir}')
@@ -135,7 +135,8 @@ export default function Page() {
       ...formData,
       audioProcessing: audioSettings.audioSource,
       surgePath: audioSettings.surgePath,
-      remoteUrl: audioSettings.remoteUrl
+      remoteURL: audioSettings.remoteUrl,
+      job_id: null as string | null,
     };
     // parse function to make sure it's valid
     try {
@@ -149,6 +150,8 @@ export default function Page() {
 
       const responseData = await response.json();
       console.log('parsing function:', responseData.status);
+      // every later step works inside this job's directory
+      requestData.job_id = responseData.job_id;
       if (responseData.status === 'fail') {
         // invalid function, set all statuses to false
         setStatus((prev) => ({
@@ -257,7 +260,7 @@ export default function Page() {
     // video was successfully created. time to upload to supabase.
     try {
       // pull file from folder
-      const filePath = `/animations/${formData.function}.mp4`;
+      const filePath = `/animations/${requestData.job_id}/sonification.mp4`;
       const blob = await fetch(filePath).then((res) => res.blob());
       const file = new Blob([blob], { type: 'video/mp4' });
 
@@ -147,6 +147,7 @@ export default function Page() {
       audioProcessing: audioSettings.audioSource,
       surgePath: audioSettings.surgePath,
       remoteURL: audioSettings.remoteUrl,
+      job_id: null as string | null,
     };
 
     console.log("Sending request with audio settings:", dataWithSettings);
@@ -163,6 +164,8 @@ export default function Page() {
 
       const responseData = await response.json();
       console.log('parsing ticker:', responseData.status);
+      // every later step works inside this job's directory
+      dataWithSettings.job_id = responseData.job_id;
       if (responseData.status === 'fail') {
         // invalid ticker, set all statuses to false
         setStatus((prev) => ({
@@ -271,7 +274,7 @@ export default function Page() {
     // video was successfully created. time to upload to supabase.
     try {
       // pull file from folder
-      const filePath = `/animations/${formData.ticker}.mp4`;
+      const filePath = `/animations/${dataWithSettings.job_id}/sonification.mp4`;
       const blob = await fetch(filePath).then((res) => res.blob());
       const file = new Blob([blob], { type: 'video/mp4' });
 
@@ -125,7 +125,7 @@ export default function Translation() {
       // video successfully created, time to upload to supabase
       try {
         // pull file from folder
-        const filePath = `/animations/translation_sonify.mp4`;
+        const filePath = responseData.video;
         const blob = await fetch(filePath).then((res) => res.blob());
         const file = new Blob([blob], { type: 'video/mp4' });
 
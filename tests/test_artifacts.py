@@ -0,0 +1,44 @@
+# serving rendered files out of a temporary output directory
+import asyncio
+import pytest
+from api import artifacts
+from api.artifacts import follow, parse_range, serve_artifact
+
+JOB_ID = 'b' * 32
+
+
+@pytest.fixture
+def job_dir(monkeypatch, tmp_path):
+  monkeypatch.setattr(artifacts, 'OUTPUT_DIR', str(tmp_path))
+  (tmp_path / JOB_ID).mkdir()
+  return tmp_path / JOB_ID
+
+def test_parse_range():
+  assert parse_range('bytes=0-9', 100) == (0, 9)
+  assert parse_range('bytes=90-', 100) == (90, 99)
+  assert parse_range('bytes=-10', 100) == (90, 99)
+  assert parse_range('bytes=0-9,20-29', 100) is None
+  with pytest.raises(ValueError):
+    parse_range('bytes=100-', 100)
+
+def test_head_has_the_get_headers_and_no_body(job_dir):
+  (job_dir / 'sonification.mp4').write_bytes(b'x' * 100)
+  get = serve_artifact(JOB_ID, 'sonification.mp4', 'bytes=10-19')
+  head = serve_artifact(JOB_ID, 'sonification.mp4', 'bytes=10-19', head=True)
+  assert head.status_code == get.status_code == 206
+  assert head.headers['content-range'] == get.headers['content-range'] == 'bytes 10-19/100'
+  assert head.headers['content-length'] == '10'
+  assert head.body == b''
+
+def test_follow_closes_the_file_when_the_client_goes_away(job_dir):
+  path = job_dir / 'sonification.mp4.part'
+  path.write_bytes(b'x' * 10)
+
+  async def main():
+    f = open(path, 'rb')
+    stream = follow(f, str(path))
+    assert await stream.__anext__() == b'x' * 10
+    # what the server does when the client disconnects mid stream
+    await stream.aclose()
+    assert f.closed
+  asyncio.run(main())
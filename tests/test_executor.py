@@ -0,0 +1,50 @@
+# render pool recovery after a worker dies
+import asyncio
+import os
+import time
+from concurrent.futures.process import BrokenProcessPool
+import pytest
+from api import executor
+
+
+def test_pool_is_replaced_after_a_worker_dies():
+  async def main():
+    restarts = executor.get_pool_stats()['restarts']
+    # the worker exits without a result, like one killed for running out of memory
+    with pytest.raises(BrokenProcessPool):
+      await executor.run_in_pool(os._exit, 1)
+    assert executor.get_pool_stats()['restarts'] == restarts + 1
+
+    # the next render gets a fresh pool
+    assert await executor.run_in_pool(os.getpid) != os.getpid()
+    assert executor.get_pool_stats()['in_flight'] == 0
+
+  try:
+    asyncio.run(main())
+  finally:
+    executor.shutdown_executor()
+
+def test_cancelled_render_counts_until_its_worker_is_done():
+  async def main():
+    # start a worker first, so the render below is running when it is cancelled
+    await executor.run_in_pool(os.getpid)
+    in_flight = executor.get_pool_stats()['in_flight']
+
+    task = asyncio.create_task(executor.run_in_pool(time.sleep, 1))
+    await asyncio.sleep(0.3)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+      await task
+    # the worker is still sleeping
+    assert executor.get_pool_stats()['in_flight'] == in_flight + 1
+
+    for _ in range(50):
+      if executor.get_pool_stats()['in_flight'] == in_flight:
+        break
+      await asyncio.sleep(0.1)
+    assert executor.get_pool_stats()['in_flight'] == in_flight
+
+  try:
+    asyncio.run(main())
+  finally:
+    executor.shutdown_executor()
@@ -0,0 +1,83 @@
+# background job bookkeeping, with coroutines standing in for renders
+import asyncio
+import pytest
+from api import jobs as jobs_module, utils
+from api.executor import RenderQueueFull
+from api.jobs import JobManager, JobRunning
+from api.utils import new_job_id
+
+
+@pytest.fixture(autouse=True)
+def output_dir(monkeypatch, tmp_path):
+  monkeypatch.setattr(utils, 'OUTPUT_DIR', str(tmp_path))
+  monkeypatch.setattr(jobs_module, 'OUTPUT_DIR', str(tmp_path))
+  return tmp_path
+
+async def wait_for(event: asyncio.Event):
+  await event.wait()
+  return {'video': 'done'}
+
+
+def test_submissions_over_capacity_are_turned_away():
+  async def main():
+    manager = JobManager(capacity=2)
+    release = asyncio.Event()
+    first = manager.submit(new_job_id(), 'math', wait_for(release))
+    manager.submit(new_job_id(), 'math', wait_for(release))
+    # jobs still in their prelude count too, nothing has reached the pool yet
+    with pytest.raises(RenderQueueFull):
+      manager.submit(new_job_id(), 'math', wait_for(release))
+
+    release.set()
+    await first.task
+    await asyncio.sleep(0)
+    assert manager.active() == 0
+    manager.submit(new_job_id(), 'math', wait_for(release))
+  asyncio.run(main())
+
+def test_running_job_id_cannot_be_submitted_again():
+  async def main():
+    manager = JobManager()
+    release = asyncio.Event()
+    job_id = new_job_id()
+    manager.submit(job_id, 'math', wait_for(release))
+    with pytest.raises(JobRunning):
+      manager.submit(job_id, 'math', wait_for(release))
+    release.set()
+    await manager.get(job_id).task
+  asyncio.run(main())
+
+def test_other_processes_see_the_job_through_its_file():
+  async def main():
+    owner, other = JobManager(), JobManager()
+    release = asyncio.Event()
+    job = owner.submit(new_job_id(), 'stocks', wait_for(release))
+    # other stands in for a second server process, it never saw the submit
+    assert other.get(job.job_id).snapshot()['status'] == 'running'
+
+    release.set()
+    await job.task
+    snapshot = other.get(job.job_id).snapshot()
+    assert snapshot['status'] == 'succeeded'
+    assert snapshot['result'] == {'video': 'done'}
+    assert other.get(new_job_id()) is None
+  asyncio.run(main())
+
+def test_cancel_from_another_process_reaches_the_render(output_dir):
+  async def main():
+    owner, other = JobManager(), JobManager()
+    job = owner.submit(new_job_id(), 'math', wait_for(asyncio.Event()))
+    await other.cancel(job.job_id)
+    # the render sees the marker at its next progress update
+    assert (output_dir / job.job_id / '.cancel').exists()
+    await owner.cancel(job.job_id)
+    assert other.get(job.job_id).status == 'cancelled'
+  asyncio.run(main())
+
+def test_job_of_an_exited_process_is_failed(output_dir):
+  job_id = new_job_id()
+  (output_dir / job_id).mkdir()
+  jobs_module.Job(job_id, 'math', pid=2 ** 22 + 1).save()
+  snapshot = JobManager().get(job_id).snapshot()
+  assert snapshot['status'] == 'failed'
+  assert 'exited' in snapshot['error']
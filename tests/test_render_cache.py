@@ -0,0 +1,49 @@
+# render cache on a temporary directory
+import os
+import pytest
+from api.render_cache import RenderCache, sonification_cache_key
+from api.utils import MathWaveSonificationConfig
+
+
+@pytest.fixture
+def cache(tmp_path):
+  return RenderCache(str(tmp_path / 'cache'), max_bytes=1024)
+
+def test_fetch_replaces_an_existing_file(cache, tmp_path):
+  source = tmp_path / 'video.mp4'
+  source.write_bytes(b'video')
+  cache.store('key', str(source))
+
+  destination = tmp_path / 'job' / 'sonification.mp4'
+  destination.parent.mkdir()
+  # the same job id sent again after a cache hit
+  assert cache.fetch('key', str(destination))
+  assert cache.fetch('key', str(destination))
+  assert destination.read_bytes() == b'video'
+  assert os.listdir(destination.parent) == ['sonification.mp4']
+
+def test_entry_evicted_during_fetch_is_still_a_hit(cache, tmp_path, monkeypatch):
+  source = tmp_path / 'video.mp4'
+  source.write_bytes(b'video')
+  cache.store('key', str(source))
+
+  def evicted(path):
+    raise FileNotFoundError(path)
+  monkeypatch.setattr(os, 'utime', evicted)
+  destination = tmp_path / 'sonification.mp4'
+  assert cache.fetch('key', str(destination))
+  assert destination.read_bytes() == b'video'
+
+def test_miss(cache, tmp_path):
+  assert not cache.fetch('missing', str(tmp_path / 'sonification.mp4'))
+  assert cache.stats()['misses'] == 1
+
+def test_keys_only_depend_on_what_changes_the_output():
+  def key(**fields):
+    return sonification_cache_key(MathWaveSonificationConfig(function='sin(x)', **fields))
+  # videos don't depend on the audio only format, audio doesn't depend on the plot
+  assert key() == key(audio_format='mp3', job_id='a' * 32, output_format='hls')
+  assert key() != key(title='another title')
+  assert key(audio_only=True) == key(audio_only=True, title='another title')
+  assert key(audio_only=True) != key(audio_only=True, audio_format='mp3')
+  assert key(audioProcessing='surge-local') is None
@@ -0,0 +1,77 @@
+# remote surge client against a mock server, no network involved
+import asyncio
+import os
+import httpx
+import pytest
+from api import surge_remote
+
+WAV = b'RIFF' + b'\0' * 1000
+
+
+@pytest.fixture
+def mock_server(monkeypatch):
+  # installs handler as the remote server and records every request it gets
+  requests = []
+
+  def install(handler):
+    def record(request):
+      requests.append(request)
+      return handler(request)
+    monkeypatch.setattr(surge_remote, '_client', httpx.AsyncClient(transport=httpx.MockTransport(record)))
+    return requests
+
+  monkeypatch.setattr(surge_remote, 'SURGE_REMOTE_BACKOFF', 0)
+  return install
+
+def fetch(file_path, url='http://surge.test/'):
+  return asyncio.run(surge_remote.fetch_remote_audio(url, 'generate_audio', {'data': [1, 2, 3]}, str(file_path)))
+
+
+class FailingStream(httpx.AsyncByteStream):
+  # the connection drops halfway through the body
+  async def __aiter__(self):
+    yield WAV[:100]
+    raise httpx.ReadError('connection reset')
+
+
+def test_busy_server_is_retried(mock_server, tmp_path):
+  responses = iter([httpx.Response(503, text='busy'), httpx.Response(200, content=WAV)])
+  requests = mock_server(lambda request: next(responses))
+
+  path = tmp_path / 'audio.wav'
+  assert fetch(path) == str(path)
+  assert path.read_bytes() == WAV
+  assert len(requests) == 2
+  assert str(requests[0].url) == 'http://surge.test/generate_audio'
+
+def test_persistent_failure_raises_after_every_attempt(mock_server, tmp_path):
+  requests = mock_server(lambda request: httpx.Response(503, text='busy'))
+
+  with pytest.raises(RuntimeError, match='503'):
+    fetch(tmp_path / 'audio.wav')
+  assert len(requests) == surge_remote.SURGE_REMOTE_RETRIES + 1
+  assert os.listdir(tmp_path) == []
+
+def test_connection_errors_are_retried(mock_server, tmp_path):
+  def handler(request):
+    raise httpx.ConnectError('connection refused')
+  requests = mock_server(handler)
+
+  with pytest.raises(RuntimeError, match='Could not reach'):
+    fetch(tmp_path / 'audio.wav')
+  assert len(requests) == surge_remote.SURGE_REMOTE_RETRIES + 1
+
+def test_other_errors_are_not_retried(mock_server, tmp_path):
+  requests = mock_server(lambda request: httpx.Response(400, text='bad data'))
+
+  with pytest.raises(RuntimeError, match='bad data'):
+    fetch(tmp_path / 'audio.wav')
+  assert len(requests) == 1
+
+def test_failed_download_leaves_nothing_behind(mock_server, tmp_path):
+  mock_server(lambda request: httpx.Response(200, stream=FailingStream()))
+
+  with pytest.raises(RuntimeError):
+    fetch(tmp_path / 'audio.wav')
+  # neither the .part nor a half written wav
+  assert os.listdir(tmp_path) == []